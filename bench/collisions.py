@@ -0,0 +1,57 @@
+#installs a zip whose member names look like the temp files of a write, <member>.tmp
+#and <member>.gpm-tmp listed before <member>, extracted directly and placed from an
+#object store, with one and several jobs. checks every member ends up with its own
+#content and remove leaves nothing behind, prints the cases as json
+#usage: python bench/collisions.py
+import sys
+import json
+import tempfile
+import contextlib
+import io
+from zipfile import ZipFile
+from collections import OrderedDict as odict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'gpm'))
+import quakebsp
+from store import ObjectStore
+from extract import package
+
+members = odict([
+    ('maps/x.bsp.tmp', b'tmp member ' * 100),
+    ('maps/x.bsp', b'x member ' * 100),
+    ('maps/y.bsp.gpm-tmp', b'gpm-tmp member ' * 100),
+    ('maps/y.bsp', b'y member ' * 100),
+])
+
+def run():
+    results = odict()
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        cachep = d / 'cache'
+        cachep.mkdir()
+        with ZipFile(str(cachep / 'collide.zip'), 'w') as zf:
+            for name, data in members.items():
+                zf.writestr(name, data)
+        p = package(cachep, 'collide.zip')
+        for unpacked in [False, True]:
+            for jobs in [1, 8]:
+                case = '%s, jobs %i' % ('store' if unpacked else 'zip', jobs)
+                root = d / ('quake %s' % case)
+                root.mkdir()
+                quakebsp.QuakeBsp.quake_path = root
+                h = quakebsp.QuakeBsp()
+                store = ObjectStore(d / 'store') if unpacked else None
+                with contextlib.redirect_stdout(io.StringIO()):
+                    state = h.install(p, p['files'], cachep, False, store=store, link_mode='copy', jobs=jobs)
+                for name, data in members.items():
+                    assert (root / 'id1' / name).read_bytes() == data, (case, name)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    h.remove(p, state)
+                left = [str(f.relative_to(root)) for f in root.rglob('*')]
+                assert not left, (case, left)
+                results[case] = 'ok'
+    print(json.dumps(results, indent=1))
+
+if __name__ == '__main__':
+    run()
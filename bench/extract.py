@@ -0,0 +1,62 @@
+#zip extraction benchmark: installs a synthetic zip with many small members
+#usage: python bench/extract.py [members] [member_size]
+import sys
+import os
+import time
+import random
+import tempfile
+import contextlib
+import io
+from zipfile import ZipFile, ZIP_DEFLATED
+from collections import OrderedDict as odict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'gpm'))
+import quakebsp
+from indexer import container_fileinfos
+from common import hash_path
+
+def make_zip(path, members, member_size, seed=1):
+    rnd = random.Random(seed)
+    with ZipFile(str(path), 'w', ZIP_DEFLATED) as zf:
+        for i in range(members):
+            #half random, half compressible
+            data = bytes(rnd.getrandbits(8) for _ in range(member_size // 2)) + b'q' * (member_size // 2)
+            zf.writestr('maps/d%i/m%i.bsp' % (i % 64, i), data)
+
+def package(cachep, name):
+    zpath = cachep / name
+    files = odict([(name, odict([('sha1', hash_path(zpath)), ('size', zpath.stat().st_size),
+                                 ('subfiles', container_fileinfos(zpath))]))])
+    return odict([('name', 'bench'), ('version', '1.0.0'), ('type', {quakebsp.QuakeBsp.name: {}}), ('files', files)])
+
+def timed(fn):
+    #handler logs every file, keep that out of the timing
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = time.perf_counter()
+        r = fn()
+        return time.perf_counter() - t, r
+
+def run(members, member_size):
+    print('%i cpus' % os.cpu_count())
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        cachep = d / 'cache'
+        cachep.mkdir()
+        make_zip(cachep / 'bench.zip', members, member_size)
+        p = package(cachep, 'bench.zip')
+        for jobs in [1, 8]:
+            root = d / ('quake%i' % jobs)
+            root.mkdir()
+            quakebsp.QuakeBsp.quake_path = root
+            h = quakebsp.QuakeBsp()
+            dt, state = timed(lambda: h.install(p, p['files'], cachep, False, jobs=jobs))
+            print('%6i members  jobs %2i  fresh      %8.3f s' % (members, jobs, dt))
+            owned = set(h.owned(p, state))
+            dt, state = timed(lambda: h.install(p, p['files'], cachep, False, owned, jobs=jobs))
+            print('%6i members  jobs %2i  unchanged  %8.3f s' % (members, jobs, dt))
+
+if __name__ == '__main__':
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    member_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    run(members, member_size)
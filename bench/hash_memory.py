@@ -0,0 +1,41 @@
+#hashing memory benchmark: peak python allocations must stay flat as file size grows
+#usage: python bench/hash_memory.py [size_mb ...]
+import sys
+import time
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'gpm'))
+from common import hash_path_multi
+
+def make_file(d, size):
+    p = Path(d) / ('%i.bin' % size)
+    chunk = bytes(range(256)) * 4096
+    with p.open('wb') as f:
+        written = 0
+        while written < size:
+            n = min(len(chunk), size - written)
+            f.write(chunk[:n])
+            written += n
+    return p
+
+def run(sizes_mb, algorithms=('sha1', 'sha256', 'blake2b')):
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        for mb in sizes_mb:
+            p = make_file(d, mb << 20)
+            tracemalloc.start()
+            t = time.perf_counter()
+            digests = hash_path_multi(p, algorithms)
+            dt = time.perf_counter() - t
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert digests['size'] == mb << 20
+            results.append((mb, dt, peak))
+            print('%6i MB  %8.3f s  %8.1f MB/s  peak %8.1f KiB' % (mb, dt, mb / dt, peak / 1024))
+    return results
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [8, 32, 128, 512]
+    run(sizes)
@@ -0,0 +1,56 @@
+#memory of a loaded files index as nested odicts against FileInfo records, on a
+#synthetic index shaped like repo.files.json. prints retained and peak python
+#allocations and parse time as json, and checks FileInfo records dump back to the same text
+#usage: python bench/manifest_memory.py [packages] [versions] [members]
+import sys
+import json
+import time
+import random
+import hashlib
+import tracemalloc
+from collections import OrderedDict as odict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'gpm'))
+from common import json_pairs, json_default
+
+def make_index(packages, versions, members, seed=1):
+    #name -> version -> {name.zip: {sha1, size, subfiles}} as json text
+    rnd = random.Random(seed)
+    def sha1():
+        return hashlib.sha1(rnd.getrandbits(64).to_bytes(8, 'little')).hexdigest()
+    index = odict()
+    for i in range(packages):
+        name = 'p%i' % i
+        index[name] = odict()
+        for v in range(versions):
+            subfiles = odict([('maps/', odict([('size', 0)]))])
+            for j in range(members):
+                subfiles['maps/%s_%i.bsp' % (name, j)] = odict([('size', rnd.randint(1, 1 << 20)), ('sha1', sha1())])
+            index[name]['1.0.%i' % v] = odict([
+                (name + '.zip', odict([('sha1', sha1()), ('size', rnd.randint(1, 1 << 24)), ('subfiles', subfiles)]))])
+    return json.dumps(index)
+
+def measure(text, hook):
+    tracemalloc.start()
+    t = time.perf_counter()
+    data = json.loads(text, object_pairs_hook=hook)
+    dt = time.perf_counter() - t
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, odict([('retained', retained), ('peak', peak), ('parse seconds', round(dt, 3))])
+
+def run(packages=2000, versions=2, members=50):
+    text = make_index(packages, versions, members)
+    results = odict([('files', packages * versions * (members + 2)), ('json bytes', len(text))])
+    data, results['odict'] = measure(text, odict)
+    plain = json.loads(json.dumps(data))
+    del data
+    data, results['FileInfo'] = measure(text, json_pairs)
+    assert json.loads(json.dumps(data, default=json_default)) == plain
+    assert json.dumps(data, default=json_default) == text
+    results['ratio'] = round(results['odict']['retained'] / results['FileInfo']['retained'], 2)
+    print(json.dumps(results, indent=1))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
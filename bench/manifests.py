@@ -0,0 +1,75 @@
+#--update with the file lists merged into the sync (repo.files.json) against per
+#package version manifests loaded by install, on a synthetic repository. prints
+#bytes fetched by update and install and the size of the local repos dir as json
+#usage: python bench/manifests.py [packages] [members]
+import os
+import sys
+import json
+import shutil
+import tempfile
+from pathlib import Path
+
+bench_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(bench_dir))
+sys.path.insert(0, str(bench_dir.parent / 'gpm'))
+import synthetic
+from synthetic import ns, load_cli
+
+repo = 'synthetic'
+roots = 3
+
+def dir_size(d):
+    return sum([p.stat().st_size for p in d.rglob('*') if p.is_file()])
+
+def run(packages=1000, members=64):
+    import instrument
+    tmp = Path(tempfile.mkdtemp(prefix='gpm-manifests-'))
+    cwd = os.getcwd()
+    try:
+        pkg_dirs = synthetic.make_repo(tmp / 'pkgs', packages, 3, 4 << 10, members)
+        pub_home = tmp / 'publisher'
+        pub_home.mkdir()
+        cli = load_cli(pub_home)
+        cli.repos_filepath = tmp / 'pub'
+        cli.add(ns(repo=repo, paths=pkg_dirs, force=False, jobs=1, rehash=True), {}, {})
+        dl = tmp / 'dl'
+        dl.mkdir()
+        for p in pkg_dirs:
+            shutil.copy(str(p / (p.name + '.zip')), str(dl))
+        base = 'file://%s/pub/%s' % (tmp, repo)
+        results = {'published': {'repo': (tmp / 'pub' / (repo + '.json')).stat().st_size,
+                                 'files': (tmp / 'pub' / (repo + '.files.json')).stat().st_size}}
+        for layout in ['merged', 'sharded']:
+            home = tmp / layout
+            home.mkdir()
+            cli = load_cli(home)
+            cli.repos_filepath = home / 'repos'
+            cli.cache_dir = home / 'cache'
+            cli.quakebsp.QuakeBsp.quake_path = home / 'quake'
+            cli.quakebsp.QuakeBsp.quake_path.mkdir()
+            cli.repo_dl_dir = 'file://%s/' % dl
+            furl = base + '.files.json' if layout == 'merged' else None
+            cli.repositories = {repo: [(base + '.json', furl)]}
+            instrument.enable()
+            r = {}
+            for phase in ['update', 'install']:
+                del instrument.spans[:]
+                instrument.loose.clear()
+                if phase == 'update':
+                    repo_data = cli.update_repos(cli.repositories)
+                    package_data = cli.load_package_index(cli.repositories, repo_data)
+                else:
+                    cli.install(ns(packages=[p.name for p in pkg_dirs[-roots:]], force=False, jobs=1, unpacked=None, dry_run=False),
+                                package_data, repo_data)
+                phases, by_package = instrument.totals()
+                r[phase + ' downloaded'] = sum([p.get('downloaded', 0) for p in phases.values()])
+            package_data.db.close()
+            r['local repos'] = dir_size(cli.repos_filepath)
+            results[layout] = r
+        print(json.dumps({'packages': packages, 'members': members, 'results': results}, indent=1))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(str(tmp), ignore_errors=True)
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
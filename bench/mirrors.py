@@ -0,0 +1,74 @@
+#--update against local stand-in mirrors with injected latency and failures. every
+#repository lists a broken mirror, a slow one and a fast one in a different order,
+#update has to end up with the same index either way. times mirrors tried one
+#after another for one repository at a time against all repositories at once with
+#raced mirrors
+#usage: python bench/mirrors.py [repos] [packages]
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+bench_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(bench_dir))
+sys.path.insert(0, str(bench_dir.parent / 'gpm'))
+from synthetic import load_cli, serve
+
+def publish(root, repo, packages):
+    data, files = {}, {}
+    for i in range(packages):
+        name = '%s-p%i' % (repo, i)
+        data[name] = {'1.0.0': {'name': name, 'version': '1.0.0', 'dependencies': {}}}
+        files[name] = {'1.0.0': {'%s.zip' % name: {'size': 1, 'sha1': '0' * 40}}}
+    (root / (repo + '.json')).write_text(json.dumps(data))
+    (root / (repo + '.files.json')).write_text(json.dumps(files))
+    return data
+
+def run(repos=8, packages=200):
+    tmp = Path(tempfile.mkdtemp(prefix='gpm-mirrors-'))
+    cwd = os.getcwd()
+    try:
+        pub = tmp / 'pub'
+        pub.mkdir()
+        expected = dict([(r, publish(pub, r, packages)) for r in ['r%i' % i for i in range(repos)]])
+        servers = [serve(pub, fail=500), serve(pub, latency=2.0), serve(pub, latency=0.05)]
+        urls = [u for s, u in servers]
+        repositories = {}
+        for i, r in enumerate(expected):
+            order = urls[i % 3:] + urls[:i % 3]
+            repositories[r] = [(u + r + '.json', u + r + '.files.json') for u in order]
+
+        import download
+        results = {}
+        for mode in ['sequential', 'concurrent']:
+            cli = load_cli(tmp / mode)
+            cli.repos_filepath.mkdir(parents=True, exist_ok=True)
+            t = time.perf_counter()
+            if mode == 'sequential':
+                #no mirror is started before the one ahead of it failed
+                download.mirror_stagger = float('inf')
+                repo_data = {}
+                for r, mirrors in repositories.items():
+                    repo_data.update(cli.update_repos({r: mirrors}))
+            else:
+                download.mirror_stagger = 0.25
+                repo_data = cli.update_repos(repositories)
+            results[mode] = time.perf_counter() - t
+            for r, data in repo_data.items():
+                assert list(data) == list(expected[r]), r
+                for name in data:
+                    assert data[name]['1.0.0']['files'], name
+        for s, u in servers:
+            s.shutdown()
+            s.server_close()
+        print(json.dumps({'repos': repos, 'packages': packages, 'seconds': results}, indent=1))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(str(tmp), ignore_errors=True)
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    run(*args)
@@ -0,0 +1,94 @@
+#upgrade of one large package where a single member changed, with the archives
+#served by a local stand-in that supports http range requests and by one that
+#does not. prints bytes downloaded and written per upgrade as json
+#usage: python bench/partial.py [zip_size] [members]
+import os
+import sys
+import json
+import shutil
+import random
+import tempfile
+from pathlib import Path
+
+bench_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(bench_dir))
+sys.path.insert(0, str(bench_dir.parent / 'gpm'))
+import synthetic
+from synthetic import ns, load_cli, serve
+
+def upgrade(tmp, dl, url, zip_size, members):
+    #installs p0 1.0.0 from dl, then upgrades to 1.0.1 from url. returns the
+    #upgrade's counters
+    home = tmp / 'home'
+    cli = load_cli(home)
+    import quakebsp, instrument
+    cli.cache_dir = home / 'cache'
+    cli.backup_dir = cli.cache_dir / '.backup'
+    quakebsp.QuakeBsp.quake_path = home / 'quake'
+    quakebsp.QuakeBsp.quake_path.mkdir()
+
+    pkgs = tmp / 'pkgs'
+    v1 = synthetic.make_package(pkgs / 'v1', 'p0', '1.0.0', {}, zip_size, members, random.Random(1))
+    v2 = synthetic.make_package(pkgs / 'v2', 'p0', '1.0.1', {}, zip_size, members, random.Random(1))
+    #same members except the last one
+    rewrite_last(v2 / 'p0.zip')
+    cli.repos_filepath = home / 'pub'
+    cli.add(ns(repo='r', paths=[v1, v2], force=False, jobs=1, rehash=True), {}, {})
+    cli.repos_filepath = home / 'repos'
+    repositories = {'r': [('file://%s/pub/r.json' % home, 'file://%s/pub/r.files.json' % home)]}
+    repo_data = cli.update_repos(repositories)
+    package_data = cli.load_package_index(repositories, repo_data)
+
+    shutil.copy(str(v1 / 'p0.zip'), str(dl))
+    cli.repo_dl_dir = 'file://%s/' % dl
+    old = {'p0': {'1.0.0': package_data['p0']['1.0.0']}}
+    cli.install(ns(packages=['p0'], force=False, jobs=4, unpacked=None, dry_run=False), old, repo_data)
+
+    (dl / 'p0.zip').unlink()
+    shutil.copy(str(v2 / 'p0.zip'), str(dl))
+    cli.repo_dl_dir = url
+    cli.install(ns(packages=['p0'], force=False, jobs=4, unpacked=None, dry_run=True), package_data, repo_data)
+    instrument.enable()
+    del instrument.spans[:]
+    instrument.loose.clear()
+    cli.install(ns(packages=['p0'], force=False, jobs=4, unpacked=None, dry_run=False), package_data, repo_data)
+    from zipfile import ZipFile
+    with ZipFile(str(v2 / 'p0.zip')) as zf:
+        for i in zf.infolist():
+            installed = quakebsp.QuakeBsp.quake_path / 'id1' / i.filename
+            assert i.is_dir() or installed.read_bytes() == zf.read(i), i.filename
+    phases, packages = instrument.totals()
+    return dict([(c, sum([p.get(c, 0) for p in phases.values()])) for c in ['downloaded', 'written', 'files']])
+
+def rewrite_last(path):
+    #replaces the content of the last member with as many other bytes
+    from zipfile import ZipFile, ZIP_DEFLATED
+    with ZipFile(str(path)) as zf:
+        items = [(i, zf.read(i)) for i in zf.infolist()]
+    last, data = items[-1]
+    items[-1] = (last, bytes(reversed(data)))
+    with ZipFile(str(path), 'w', ZIP_DEFLATED) as zf:
+        for i, data in items:
+            zf.writestr(i.filename, data)
+
+def run(zip_size=16 << 20, members=64):
+    results = {}
+    cwd = os.getcwd()
+    for ranges in [True, False]:
+        tmp = Path(tempfile.mkdtemp(prefix='gpm-partial-'))
+        try:
+            dl = tmp / 'dl'
+            dl.mkdir()
+            server, url = serve(dl, ranges=ranges)
+            try:
+                results['ranges' if ranges else 'no ranges'] = upgrade(tmp, dl, url, zip_size, members)
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(str(tmp), ignore_errors=True)
+    print(json.dumps({'zip_size': zip_size, 'members': members, 'upgrade': results}, indent=1))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,52 @@
+#checks resolver.satisfies against what node-semver answers for the same version
+#and range, prints the number of cases and every mismatch as json
+#usage: python bench/ranges.py
+import sys
+import json
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'gpm'))
+import resolver
+
+#(version, range, node-semver satisfies)
+cases = [
+    ('1.2.3', '^1.2.0', True),
+    ('2.0.0', '^1.2.0', False),
+    ('0.2.5', '^0.2.3', True),
+    ('0.3.0', '^0.2.3', False),
+    ('0.0.4', '^0.0.3', False),
+    ('1.2.9', '~1.2.3', True),
+    ('1.3.0', '~1.2.3', False),
+    ('1.9.0', '~1', True),
+    ('1.5.0', '1.x', True),
+    ('2.0.0', '1.x', False),
+    ('3.0.0', '*', True),
+    ('1.2.3-beta', '*', False),
+    ('1.3.0', '>1.2', True),
+    ('1.2.9', '>1.2', False),
+    ('1.3.0-beta', '>1.2', False),
+    ('2.0.0', '>1', True),
+    ('2.0.0-beta', '>1', False),
+    ('1.2.9', '<=1.2', True),
+    ('1.3.0', '<=1.2', False),
+    ('1.3.0-beta', '<=1.2', False),
+    ('1.1.9', '<1.2', True),
+    ('1.2.0', '<1.2', False),
+    ('1.2.0', '1.0.0 - 1.2', True),
+    ('1.3.0', '1.0.0 - 1.2', False),
+    ('1.2.3-beta.2', '>=1.2.3-beta.1', True),
+    ('1.2.4-beta', '>=1.2.3-beta.1', False),
+    ('1.2.3-alpha', '^1.2.3-beta', False),
+    ('2.1.0', '^1.0.0 || ^2.0.0', True),
+    ('3.0.0', '^1.0.0 || ^2.0.0', False),
+    ('1.2.0', '>= 1.2.0 < 2', True),
+]
+
+def run():
+    wrong = [(v, r, expected) for v, r, expected in cases if resolver.satisfies(v, r) != expected]
+    print(json.dumps({'cases': len(cases), 'wrong': wrong}, indent=1))
+    if wrong:
+        exit(1)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,56 @@
+#resolver benchmark on synthetic dependency graphs
+#usage: python bench/resolve.py [packages ...]
+import sys
+import time
+import random
+from collections import OrderedDict as odict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'gpm'))
+import resolver
+
+#ranges by the major version of the dependency they were written against
+ranges = {
+    1: ['^1.0.0', '~1.1.0', '1.x', '>=1.0.0 <2', '1.0.0 - 1.2'],
+    2: ['^2.0.0', '2.x', '>=2.1.0', '^1.0.0 || ^2.0.0', '*'],
+}
+
+def make_graph(n, deps=4, conflicts=0.05, seed=1):
+    #each package has 1.0.0-1.2.0 and 2.0.0-2.2.0 and depends on up to deps earlier
+    #packages, the dependency set only changes between majors. 1.x releases were
+    #written against 1.x dependencies, 2.x ones against 2.x, except for a conflicts
+    #share of 2.x releases that still pin a dependency to 1.x
+    rnd = random.Random(seed)
+    package_data = odict()
+    for i in range(n):
+        name = 'p%i' % i
+        package_data[name] = odict()
+        for major in (1, 2):
+            targets = rnd.sample(range(i), min(i, rnd.randint(0, deps)))
+            for minor in range(3):
+                v = '%i.%i.0' % (major, minor)
+                d = odict()
+                for j in targets:
+                    dep_major = 1 if major == 2 and rnd.random() < conflicts else major
+                    d['p%i' % j] = rnd.choice(ranges[dep_major])
+                package_data[name][v] = odict([('name', name), ('version', v), ('dependencies', d)])
+    return package_data
+
+def run(sizes, roots=10):
+    for n in sizes:
+        package_data = make_graph(n)
+        resolver.parse_range.cache_clear()
+        resolver.satisfies.cache_clear()
+        names = list(package_data)[-roots:]
+        t = time.perf_counter()
+        try:
+            r = resolver.Resolver(package_data).resolve([(name, '') for name in names], names)
+            result = '%6i resolved' % len(r)
+        except resolver.ResolveError as e:
+            result = 'unsatisfiable'
+        dt = time.perf_counter() - t
+        print('%6i packages  %s  %8.3f s' % (n, result, dt))
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [100, 1000, 5000]
+    run(sizes)
@@ -0,0 +1,84 @@
+#checks resumed downloads against the stand-in mirror of bench/synthetic.py:
+#a .part is continued where it ends, a complete .part gets a 416 and is only
+#verified, a server that ignores Range sends the whole file again and a .part with
+#wrong bytes fails the hash and is discarded. prints bytes downloaded per case as json
+#usage: python bench/resume.py [size]
+import sys
+import json
+import shutil
+import random
+import hashlib
+import tempfile
+from collections import OrderedDict as odict
+from pathlib import Path
+
+bench_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(bench_dir))
+sys.path.insert(0, str(bench_dir.parent / 'gpm'))
+from synthetic import serve
+import download
+import instrument
+
+def fetch(url, target, sha1):
+    #bytes downloaded by one fetch
+    del instrument.spans[:]
+    instrument.loose.clear()
+    download.Downloader(1).fetch(url, target, sha1)
+    phases, packages = instrument.totals()
+    return phases['fetch'].get('downloaded', 0)
+
+def run(size=4 << 20):
+    instrument.enable()
+    tmp = Path(tempfile.mkdtemp(prefix='gpm-resume-'))
+    try:
+        dl = tmp / 'dl'
+        dl.mkdir()
+        data = random.Random(1).getrandbits(8 * size).to_bytes(size, 'little')
+        (dl / 'p0.zip').write_bytes(data)
+        sha1 = hashlib.sha1(data).hexdigest()
+        half = size // 2
+        target = tmp / 'cache' / 'p0.zip'
+        part = download.Downloader.part_path(target)
+
+        def check(url, content, downloaded):
+            #fetch with content in the .part, returns bytes downloaded
+            if target.exists():
+                target.unlink()
+            part.parent.mkdir(parents=True, exist_ok=True)
+            part.write_bytes(content)
+            n = fetch(url, target, sha1)
+            assert target.read_bytes() == data and not part.exists()
+            assert n == downloaded, (n, downloaded)
+            return n
+
+        results = odict()
+        for ranges in [True, False]:
+            server, url = serve(dl, ranges=ranges)
+            url += 'p0.zip'
+            try:
+                if ranges:
+                    results['resume'] = check(url, data[:half], size - half)
+                    results['complete part'] = check(url, data, 0)
+                    target.unlink()
+                    part.write_bytes(bytes(half))
+                    try:
+                        fetch(url, target, sha1)
+                        raise AssertionError('corrupt .part was accepted')
+                    except Exception as e:
+                        if 'failed hash' not in str(e):
+                            raise
+                    assert not part.exists() and not target.exists()
+                    #the next run starts over
+                    results['corrupt part'] = fetch(url, target, sha1)
+                    assert target.read_bytes() == data and results['corrupt part'] == size
+                else:
+                    results['range ignored'] = check(url, data[:half], size)
+            finally:
+                server.shutdown()
+                server.server_close()
+        print(json.dumps({'size': size, 'downloaded': results}, indent=1))
+    finally:
+        shutil.rmtree(str(tmp), ignore_errors=True)
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
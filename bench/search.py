@@ -0,0 +1,54 @@
+#list --search on a package index of synthetic maps with titles, keywords, authors
+#and descriptions. prints index build time and query times as json
+#usage: python bench/search.py [packages]
+import sys
+import json
+import time
+import random
+import tempfile
+from collections import OrderedDict as odict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'gpm'))
+import repodb
+
+vocabulary = ('castle temple hell base fortress crypt tower sewer swamp ruins abyss gate chapel keep '
+              'dark ancient forgotten lost hidden twisted frozen burning sunken cursed black iron '
+              'medieval runic metal episode campaign speedmap jam remix quoth arcane dimension').split()
+authors = ['jpl', 'czg', 'sock', 'ionous', 'tronyn', 'markie', 'bal', 'mfx', 'kell', 'vondur']
+queries = ['castle', 'forg', 'dark temple', 'quoth camp', 'jpl', 'zzz', 'a']
+
+def make_index(packages, seed=1):
+    rnd = random.Random(seed)
+    repo = odict()
+    for i in range(packages):
+        name = 'map%i' % i
+        p = odict([
+            ('type', {'quake-bsp': {'title': ' '.join(rnd.sample(vocabulary, 3)).title(), 'zipbasedir': 'id1'}}),
+            ('name', name), ('version', '1.0.0'),
+            ('description', ' '.join(rnd.choice(vocabulary) for j in range(30))),
+            ('keywords', rnd.sample(vocabulary, 4)),
+            ('author', rnd.choice(authors)),
+            ('dependencies', {}),
+        ])
+        repo[name] = odict([('1.0.0', p)])
+    return {'synthetic': repo}
+
+def run(packages=5000, repeat=20):
+    with tempfile.TemporaryDirectory() as d:
+        db_path = Path(d) / 'index.sqlite'
+        data = make_index(packages)
+        t = time.perf_counter()
+        repodb.build(db_path, data)
+        results = odict([('packages', packages), ('build seconds', round(time.perf_counter() - t, 3)), ('queries', odict())])
+        index = repodb.PackageIndex(db_path)
+        for q in queries:
+            t = time.perf_counter()
+            for i in range(repeat):
+                found = index.search(q)
+            ms = (time.perf_counter() - t) / repeat * 1000
+            results['queries'][q] = odict([('ms', round(ms, 2)), ('matches', len(found)), ('top', [n for n, s in found[:3]])])
+        print(json.dumps(results, indent=1))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,81 @@
+#cli startup benchmark: wall clock per subcommand and the slowest imports of `list`
+#usage: python bench/startup.py [runs]
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from pathlib import Path
+
+gpm = Path(__file__).resolve().parent.parent / 'gpm'
+
+commands = [
+    ['--help'],
+    ['list'],
+    ['list', '--unrequired'],
+    ['list', '--all'],
+    ['owns', '--shared'],
+    ['check'],
+    ['cache', 'stats'],
+]
+#milliseconds of median wall clock on top of starting the bare interpreter, which
+#varies too much between machines to be part of the target
+targets = {'list': 50}
+
+def run_gpm(args, home, flags=()):
+    env = dict(os.environ, HOME=str(home))
+    #measure with cached bytecode, like an installed gpm
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    t = time.perf_counter()
+    p = subprocess.run([sys.executable] + list(flags) + [str(gpm)] + args, cwd=str(home), env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    dt = time.perf_counter() - t
+    #a command that fails early is not a fast one
+    if p.returncode:
+        raise Exception('gpm %s failed with %i:\n%s' % (' '.join(args), p.returncode, p.stderr))
+    return dt, p
+
+def importtime(args, home, top=10):
+    #[(cumulative us, module)] of gpm's own module and what it imports directly
+    dt, p = run_gpm(args, home, ['-X', 'importtime'])
+    children = []
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        #nested imports are indented by two spaces per level and come before their parent
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((int(cumulative), name.strip()))
+        elif depth == 0:
+            if name.strip() == 'cli':
+                return sorted(children + [(int(cumulative), 'cli')], reverse=True)[:top]
+            children = []
+    return []
+
+def run(runs):
+    with tempfile.TemporaryDirectory() as home:
+        home = Path(home)
+        #interpreter alone, subtracted from every command
+        times = []
+        for i in range(runs):
+            t = time.perf_counter()
+            subprocess.run([sys.executable, '-c', 'pass'], check=True)
+            times.append(time.perf_counter() - t)
+        base = sorted(times)[len(times) // 2] * 1000
+        print('%-24s %8.1f ms' % ('python -c pass', base))
+        #first run compiles the package index
+        run_gpm(['list'], home)
+        for args in commands:
+            times = sorted([run_gpm(args, home)[0] for i in range(runs)])
+            ms = times[len(times) // 2] * 1000
+            overhead = ms - base
+            target = targets.get(' '.join(args))
+            verdict = '' if target is None else ('  ok (< %i ms)' % target if overhead < target else '  SLOW (target %i ms)' % target)
+            print('%-24s %8.1f ms  +%6.1f ms%s' % (' '.join(args), ms, overhead, verdict))
+        print('slowest imports of list (cli and its direct imports):')
+        for us, name in importtime(['list'], home):
+            print('  %-22s %8.1f ms' % (name, us / 1000))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
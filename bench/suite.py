@@ -0,0 +1,157 @@
+#end to end benchmark of the gpm commands on a synthetic repository. every run
+#uses a throwaway home (config_dir), quake_path, cache and mirror, served over
+#file:// or a local http server. prints timings and peak memory per command as json
+#usage: python bench/suite.py [--packages N] [--deps N] [--zip-size BYTES] [--members N]
+#                             [--loose-size BYTES] [--mirror file|http] [--out results.json]
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import io
+import subprocess
+import tracemalloc
+import platform
+from pathlib import Path
+
+bench_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(bench_dir))
+sys.path.insert(0, str(bench_dir.parent / 'gpm'))
+import synthetic
+from synthetic import ns, load_cli, serve
+
+repo = 'synthetic'
+#installed and removed again, the packages with the most dependencies come last
+roots = 5
+
+@contextlib.contextmanager
+def mirror(kind, root):
+    #base url serving root
+    if kind == 'file':
+        yield 'file://%s/' % root
+        return
+    server, url = serve(root)
+    try:
+        yield url
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def commands(cli, pkg_dirs, url):
+    #[(name, fn)] run in this order, later commands use the state of earlier ones
+    names = [d.name for d in pkg_dirs]
+    repositories = {repo: [(url + 'pub/%s.json' % repo, url + 'pub/%s.files.json' % repo)]}
+    s = {}
+    def add():
+        pub = cli.repos_filepath
+        cli.repos_filepath = pub.parent / 'pub'
+        try:
+            cli.add(ns(repo=repo, paths=pkg_dirs, force=False, jobs=1, rehash=True), {}, {})
+        finally:
+            cli.repos_filepath = pub
+    def update():
+        s['repo_data'] = cli.update_repos(repositories)
+    def index():
+        s['package_data'] = cli.load_package_index(repositories, s['repo_data'])
+    def install():
+        cli.install(ns(packages=names[-roots:], force=False, jobs=4, unpacked=None, dry_run=False),
+                    s['package_data'], s['repo_data'])
+    def list_():
+        cli.list_packages(ns(all=True, deps=False, explicit=False, unrequired=False, search=None), s['package_data'], s['repo_data'])
+    def search():
+        cli.list_packages(ns(all=True, deps=False, explicit=False, unrequired=False, search='p1'), s['package_data'], s['repo_data'])
+    def check():
+        cli.check(ns(packages=[], full=False, jobs=0), s['package_data'], s['repo_data'])
+    def check_full():
+        cli.check(ns(packages=[], full=True, jobs=0), s['package_data'], s['repo_data'])
+    def remove():
+        cli.remove(ns(packages=names[-roots:], unneeded=True), s['package_data'], s['repo_data'])
+    return [('add', add), ('update', update), ('index', index), ('install', install), ('list', list_),
+            ('list --search', search), ('check', check), ('check --full', check_full), ('remove', remove)]
+
+def run_pass(args, pkg_dirs, measure):
+    #runs every command once in a fresh home, measure(fn) -> value per command
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+        home = root / 'home'
+        home.mkdir()
+        (root / 'quake').mkdir()
+        dl = root / 'pub'
+        dl.mkdir()
+        for p in pkg_dirs:
+            with (p / 'package.json').open('r') as f:
+                for name in json.load(f)['files']:
+                    shutil.copy(str(p / name), str(dl))
+        cwd = os.getcwd()
+        os.chdir(str(root))
+        try:
+            cli = load_cli(home)
+            cli.quakebsp.QuakeBsp.quake_path = root / 'quake'
+            cli.cache_dir = root / 'cache'
+            cli.backup_dir = cli.cache_dir / '.backup'
+            cli.repos_filepath = root / 'repos'
+            cli.repos_filepath.mkdir()
+            results = {}
+            with mirror(args.mirror, root) as url:
+                cli.repo_dl_dir = url + 'pub/'
+                for name, fn in commands(cli, pkg_dirs, url):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        results[name] = measure(fn)
+            return results
+        finally:
+            os.chdir(cwd)
+
+def timed(fn):
+    t = time.perf_counter()
+    fn()
+    return time.perf_counter() - t
+
+def peak_memory(fn):
+    #python allocations only, measured in a pass of its own since tracing slows everything down
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(bench_dir),
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gpm commands on a synthetic repository')
+    parser.add_argument('--packages', type=int, default=200)
+    parser.add_argument('--deps', type=int, default=3, help='Dependencies per package, at most')
+    parser.add_argument('--zip-size', type=int, default=256 << 10, help='Uncompressed bytes per package')
+    parser.add_argument('--members', type=int, default=16, help='Zip members per package')
+    parser.add_argument('--loose-size', type=int, default=4 << 10, help='Bytes of the plain (non-archive) file per package, 0 for none')
+    parser.add_argument('--mirror', choices=['file', 'http'], default='file')
+    parser.add_argument('--out', type=Path, help='Write the json here instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        pkg_dirs = synthetic.make_repo(d, args.packages, args.deps, args.zip_size, args.members, args.loose_size)
+        seconds = run_pass(args, pkg_dirs, timed)
+        peaks = run_pass(args, pkg_dirs, peak_memory)
+
+    r = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': dict([(k, str(v) if isinstance(v, Path) else v) for k, v in vars(args).items() if k != 'out']),
+        'commands': dict([(name, {'seconds': round(seconds[name], 4), 'peak_bytes': peaks[name]}) for name in seconds]),
+    }
+    s = json.dumps(r, indent=2)
+    if args.out:
+        args.out.write_text(s + '\n')
+    else:
+        print(s)
+
+if __name__ == '__main__':
+    main()
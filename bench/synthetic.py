@@ -0,0 +1,126 @@
+#synthetic repository generator and the helpers the benchmarks share: a fresh cli
+#per home and a local stand-in mirror
+#usage: python bench/synthetic.py <dir> [packages] [deps] [zip_size] [members] [loose_size]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import importlib
+from functools import partial
+from zipfile import ZipFile, ZIP_DEFLATED
+from pathlib import Path
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+def make_package(d, name, version, deps, zip_size, members, rnd, loose_size=0):
+    #a package directory as gpm add expects it: package.json and one zip whose
+    #members share zip_size bytes, half of every member compresses well. with
+    #loose_size also a plain <name>.pak of that many bytes next to the zip
+    d.mkdir(parents=True, exist_ok=True)
+    member_size = max(1, zip_size // members)
+    with ZipFile(str(d / (name + '.zip')), 'w', ZIP_DEFLATED) as zf:
+        zf.writestr('maps/', b'')
+        for i in range(members):
+            half = member_size // 2
+            data = rnd.getrandbits(8 * half).to_bytes(half, 'little') + b'q' * (member_size - half)
+            zf.writestr('maps/%s/%i.bsp' % (name, i), data)
+    files = [name + '.zip']
+    if loose_size:
+        (d / (name + '.pak')).write_bytes(rnd.getrandbits(8 * loose_size).to_bytes(loose_size, 'little'))
+        files.append(name + '.pak')
+    data = {
+        'name': name,
+        'version': version,
+        'type': {'quake-bsp': {'zipbasedir': 'id1'}},
+        'dependencies': deps,
+        'files': files,
+    }
+    with (d / 'package.json').open('w') as f:
+        json.dump(data, f)
+    return d
+
+def make_repo(root, packages=100, deps=3, zip_size=256 << 10, members=16, loose_size=0, seed=1):
+    #packages p0..pN-1 at 1.0.0, each depending on up to deps earlier ones.
+    #returns [package dir], dependents after their dependencies
+    rnd = random.Random(seed)
+    dirs = []
+    for i in range(packages):
+        name = 'p%i' % i
+        targets = rnd.sample(range(i), min(i, rnd.randint(0, deps)))
+        dep_ranges = dict([('p%i' % j, '^1.0.0') for j in sorted(targets)])
+        dirs.append(make_package(Path(root) / name, name, '1.0.0', dep_ranges, zip_size, members, rnd, loose_size))
+    return dirs
+
+def ns(**kw):
+    return argparse.Namespace(**kw)
+
+def load_cli(home):
+    #cli computes its paths from $HOME on import, repos_filepath is relative to the
+    #working directory. needs gpm on sys.path
+    home.mkdir(parents=True, exist_ok=True)
+    os.chdir(str(home))
+    os.environ['HOME'] = str(home)
+    import cli
+    return importlib.reload(cli)
+
+class Handler(SimpleHTTPRequestHandler):
+    #latency: seconds before every response. fail: status code instead of the file.
+    #ranges: serves single byte ranges, <start>-[end] and -<suffix>, otherwise the
+    #whole file like a server without range support
+    latency = 0
+    fail = None
+    ranges = True
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.fail:
+            self.send_error(self.fail)
+            return
+        spec = self.headers.get('Range')
+        path = Path(self.translate_path(self.path))
+        if not self.ranges or not spec or not path.is_file():
+            return super().do_GET()
+        size = path.stat().st_size
+        start, end = spec.split('=')[1].split('-')
+        if not start:
+            start, end = max(0, size - int(end)), size - 1
+        else:
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        if start >= size:
+            self.send_error(416)
+            return
+        with path.open('rb') as f:
+            f.seek(start)
+            data = f.read(end + 1 - start)
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, end, size))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        #clients close responses they do not want, like the whole file when a range was asked for
+        pass
+
+def serve(root, **kw):
+    #(server, base url) of a mirror of root, kw overrides the attributes of Handler.
+    #stop it with shutdown() and server_close()
+    handler = type('Handler', (Handler,), kw)
+    server = Server(('127.0.0.1', 0), partial(handler, directory=str(root)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%i/' % server.server_address[1]
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args:
+        print('usage: python bench/synthetic.py <dir> [packages] [deps] [zip_size] [members] [loose_size]')
+        exit(1)
+    sizes = [int(a) for a in args[1:]]
+    dirs = make_repo(args[0], *sizes)
+    print('%i packages in %s' % (len(dirs), args[0]))
@@ -0,0 +1,987 @@
+import os
+import argparse
+from pathlib import PurePath, Path
+import json
+import copy
+
+from collections import OrderedDict as odict
+
+#from zipfile import ZipFile
+#import shutil
+
+import datetime
+
+import time
+
+from common import log, warn, Hasher, FileInfo, json_pairs, json_default, hash_path, stat_fingerprint, atomic_write, rollback, commit
+import download
+from store import ObjectStore, parse_size, format_size, link_modes
+import repodb
+import instrument
+from instrument import span
+import statedb
+from download import is_url, uri2path
+#heavier modules (semver, resolver, indexer, zipfile, concurrent.futures, requests)
+#are imported by the commands that use them, gpm is called often by launchers
+
+date_format = '%Y-%m-%d %H:%M:%S %z'
+
+default_type_data = {'quake-bsp': {}}
+
+repo_ext = '.json'
+repo_files_ext = '.files' + repo_ext
+repo_delta_ext = '.delta' + repo_ext
+repo_meta_ext = '.meta' + repo_ext
+#per package version file lists, <repo>.manifests/<sha1[:2]>/<sha1>.json
+repo_manifests_ext = '.manifests'
+#entries kept in a published delta file, older clients fall back to a full fetch
+max_delta_entries = 100
+state_ext = '.json'
+
+repo_delim = '\\'
+
+config_dir = Path(os.path.expanduser('~')) / Path('.python-gpm')
+state_dir = config_dir / 'state'
+installed_db_file = state_dir / 'installed.sqlite'
+hash_cache_file = config_dir / 'hashcache.json'
+
+#json state before installed.sqlite, migrated on first use
+installed_state_dir = state_dir / 'installed'
+installed_state_file = (state_dir / 'installed').with_suffix(state_ext)
+
+def load_installed_state():
+    state = statedb.InstalledState(installed_db_file)
+    if state.migrate(installed_state_file, package_backup_file, package_state_path):
+        log('migrated %s to %s' % (installed_state_file, installed_db_file))
+    for name in state.unindexed():
+        pkg = state.package(name)
+        states = state.handler_states(name)
+        with state.transaction():
+            for t in pkg['type']:
+                state.set_owned(name, t, handlers[t]().owned(pkg, states[t]))
+    return state
+
+def package_state_path(name):
+    p = (installed_state_dir / name)
+    return p.with_suffix(p.suffix + state_ext)
+
+def package_backup_file(name):
+    return package_state_path(name).with_suffix('.package')
+
+quaddicted_local = ('remote/quaddicted_formatted', 'remote/quaddicted_formatted.files')
+#mirrors: (repo url, files url[, delta url]). without a files url, the file lists
+#are fetched per package version from the manifests next to the repo url
+repositories = {'quaddicted': [tuple('file://' + p for p in quaddicted_local)]}
+
+repos_filepath = Path('repos')
+repo_index_name = 'index.sqlite'
+
+repo_dl_dir = "https://www.quaddicted.com/filebase/"
+repo_dl_dir = "file:///home/hrehfeld/projects/quakeinjector/download/"
+
+def repo_download_url(package, path):
+    return repo_dl_dir + path
+
+def get_uri(url, binary=True):
+    with span('get_uri', url=url):
+        if is_url(url):
+            print('Downloading %s...' % url)
+            r = download.session().get(url)
+
+            if r.status_code != 200:
+                raise FileNotFoundError('Could not download file: %i (%s)' % (r.status_code, url))
+            instrument.count('downloaded', len(r.content))
+            return r.content if binary else r.text
+        else:
+            with uri2path(url).open('rb' if binary else 'r') as fd:
+                data = fd.read()
+            instrument.count('downloaded', len(data))
+            return data
+                
+
+def get_uri_conditional(url, validator=None, binary=False, timeout=None):
+    #returns (content, validator), content is None if unchanged since validator
+    with span('get_uri', url=url):
+        return get_uri_conditional_(url, validator, binary, timeout)
+
+def get_uri_conditional_(url, validator, binary, timeout):
+    validator = validator or odict()
+    if is_url(url):
+        headers = {}
+        if 'etag' in validator:
+            headers['If-None-Match'] = validator['etag']
+        if 'last_modified' in validator:
+            headers['If-Modified-Since'] = validator['last_modified']
+        print('Downloading %s...' % url)
+        r = download.session().get(url, headers=headers, timeout=timeout)
+        if r.status_code == 304:
+            return None, validator
+        if r.status_code != 200:
+            raise FileNotFoundError('Could not download file: %i (%s)' % (r.status_code, url))
+        v = odict()
+        if 'ETag' in r.headers:
+            v['etag'] = r.headers['ETag']
+        if 'Last-Modified' in r.headers:
+            v['last_modified'] = r.headers['Last-Modified']
+        instrument.count('downloaded', len(r.content))
+        return (r.content if binary else r.text), v
+    path = uri2path(url)
+    st = path.stat()
+    v = odict([('mtime', st.st_mtime_ns), ('size', st.st_size)])
+    if v == validator:
+        return None, validator
+    instrument.count('downloaded', st.st_size)
+    with path.open('rb' if binary else 'r') as fd:
+        return fd.read(), v
+
+cache_dir = Path('/tmp/ppm/')
+backup_dir = cache_dir / '.backup'
+#evict least recently used downloads beyond this
+cache_max_size = parse_size(os.environ.get('GPM_CACHE_MAX_SIZE', '4G'))
+
+#archives are read member by member over http ranges when the members an install
+#writes are less than this share of them
+partial_share = 0.5
+
+def object_store():
+    return ObjectStore(cache_dir, cache_max_size)
+
+def cache_path(package, path=None):
+    r = cache_dir / (package['name'] + '-' + package['version'])
+    if not path:
+        return r
+    return r / path
+
+def cache_current(package, path):
+    return cache_path(package, path).exists()
+
+package_keys = ['type', 'name', 'version', 'description', 'keywords', 'author', 'contributors', 'bugs', 'homepage', 'dependencies']
+
+
+
+
+
+import quakebsp                
+handlers = { quakebsp.QuakeBsp.name: quakebsp.QuakeBsp }
+    
+
+class DefaultHandler:
+    ext = 'zip'
+
+    def default_files(self, name):
+        p = Path(name)
+        return [p.with_suffix(p.suffix + '.' + self.ext)]
+        
+
+
+def repo_filepath(repo):
+    return (repos_filepath / repo).with_suffix(repo_ext)
+
+def repo_files_path(repo):
+    return repo_filepath(repo).with_suffix(repo_files_ext)
+
+def repo_delta_path(repo):
+    return repo_filepath(repo).with_suffix(repo_delta_ext)
+
+def repo_meta_path(repo):
+    return repo_filepath(repo).with_suffix(repo_meta_ext)
+
+def manifest_path(repo, sha1):
+    return repos_filepath / (repo + repo_manifests_ext) / sha1[:2] / (sha1 + repo_ext)
+
+def manifest_url(url, sha1):
+    #url: of the repo json on a mirror
+    base = url[:-len(repo_ext)] if url.endswith(repo_ext) else url
+    return '%s%s/%s/%s%s' % (base, repo_manifests_ext, sha1[:2], sha1, repo_ext)
+
+def load_manifest(repo, sha1):
+    #file list of a package version, fetched from the first mirror that has it. the
+    #name is the hash of the content, so a cached one never goes stale
+    path = manifest_path(repo, sha1)
+    if not path.exists():
+        errors = []
+        for mirror in repositories[repo]:
+            try:
+                content = get_uri(manifest_url(mirror[0], sha1))
+            except FileNotFoundError as e:
+                errors.append(str(e))
+                continue
+            hasher = Hasher((FileInfo.hash_key,))
+            hasher.update(content)
+            if hasher.hexdigest() != sha1:
+                errors.append('%s does not match its hash' % manifest_url(mirror[0], sha1))
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_write(path, 'wb') as f:
+                f.write(content)
+            break
+        else:
+            raise Exception('Could not load manifest %s of %s: %s' % (sha1, repo, '; '.join(errors)))
+    return load_json(path)
+
+def load_files(package_data, packages):
+    #fills in the files of package records that only name their manifest
+    for p in packages:
+        if 'files' not in p:
+            with span('manifest', package=p['name']):
+                p['files'] = load_manifest(package_data.repo(p['name']), p['manifest'])
+
+def write_manifests(repo, added, repo_data, repo_files):
+    for name, version in added:
+        content = json.dumps(repo_files[name][version], default=json_default).encode()
+        hasher = Hasher((FileInfo.hash_key,))
+        hasher.update(content)
+        sha1 = hasher.hexdigest()
+        path = manifest_path(repo, sha1)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(path, 'wb') as f:
+            f.write(content)
+        repo_data[name][version]['manifest'] = sha1
+
+def subrepo_path(repo, handler):
+    p = (repos_filepath / (repo + '-' + handler.name))
+    return p.with_suffix(p.suffix + repo_ext)
+
+
+class Package:
+    def __init__(self, **kwargs):
+        for a in package_keys:
+            setattr(self, a, kwargs.get('name', None))
+
+def add_s(force, paths, packages, package_data, repo_data, repo_files, jobs=1, cache=None):
+    import semver
+    from indexer import file_infos
+    handler_data = odict()
+    added = []
+    for path, data in zip(paths, packages):
+#        p = Package(**data)
+        name = data['name']
+        log('adding %s...' % name)
+
+        version = data['version']
+
+        if name in repo_data:
+            if not force and not semver.compare(version, latest_version(repo_data[name].keys())) > 0:
+                raise Exception('Package exists and version is not higher than existing package')
+            log('updating package ' + name)
+        elif name in package_data:
+            raise Exception('Package exists in other repo')
+
+        type_data = data.get('type', default_type_data)
+        types = type_data.keys()
+        for t in types:
+            assert(t in handlers)
+        _handlers = [handlers[t]() for t in types]
+
+        files = data.get('files', [])
+        if files:
+            del data['files']
+            files = [Path(f) for f in files]
+        if not files:
+            for handler in _handlers:
+                f = handler.default_files(name)
+                files += f
+        real_files = [path / f for f in files]
+        for f in real_files:
+            if not f.exists():
+                raise FileNotFoundError(str(f))
+        added.append((data, types, files, real_files))
+
+    #hash everything in one go so a pool can spread it over all packages
+    all_real_files = [f for _, _, _, real_files in added for f in real_files]
+    with span('hash'):
+        all_infos = iter(file_infos(all_real_files, jobs, cache))
+
+    for data, types, files, real_files in added:
+        name, version = data['name'], data['version']
+        file_infos_ = odict()
+        for f in files:
+            file_infos_[str(f)] = next(all_infos)
+
+        for t in types:
+            handler_data.setdefault(t, [])
+            handler_data[t].append((name, version))
+
+        p = odict()
+        for k in package_keys:
+            if k in data:
+                p[k] = data[k]
+        repo_data.setdefault(name, odict())
+        repo_data[name][version] = p
+        repo_files.setdefault(name, odict())
+        repo_files[name][version] = file_infos_
+
+    #sort by version
+    for name, versions in repo_data.items():
+        repo_data[name] = odict(sorted(versions.items(), key=lambda t: t[0]))
+
+    for name, versions in repo_files.items():
+        repo_files[name] = odict(sorted(versions.items(), key=lambda t: t[0]))
+        
+    for t, names in handler_data.items():
+        handler = handlers[t]()
+        #modifies data
+        handler.add(names, repo_data, repo_files)
+
+    return [(data['name'], data['version']) for data, _, _, _ in added]
+
+def add(args, package_data, repos):
+    repo = args.repo
+    repo_data = odict()
+    repo_files = odict()
+    if repo in repos:
+        repo_data = repos[repo]
+        repo_files = load_repo(repo_files_path(repo)) or odict()
+
+    paths = args.paths
+    packages = []
+    for path in paths:
+        pjson = path / 'package.json'
+        packages.append(load_json(pjson))
+
+    from indexer import HashCache
+    cache = None if args.rehash else HashCache(hash_cache_file)
+    added = add_s(args.force, paths, packages, package_data, repo_data, repo_files, args.jobs, cache)
+    if cache is not None:
+        cache.save()
+    write_manifests(repo, added, repo_data, repo_files)
+    write_delta(repo_delta_path(repo), added, repo_data, repo_files)
+
+    repo_path = repo_filepath(repo)
+    log('Writing ' + str(repo_path))
+    write_repo(repo_path, repo_data)
+    write_repo(repo_files_path(repo), repo_files)
+    
+def make_dirs(path):
+    created = []
+    for p in reversed([path] + list(path.parents)):
+        #print(p)
+        if not p.exists():
+            p.mkdir()
+            created.append(p)
+    return created
+    
+def latest_version(versions):
+    return sorted(versions)[-1]
+
+def check_file_conflicts(to_install, package_data, installed_packages, force):
+    #finds files claimed with different content by two of the packages or owned by
+    #another installed one before anything is extracted. a package may replace its
+    #own files. returns (name, type) -> targets that an earlier package of to_install
+    #writes with the same content, skipped by the later ones
+    claims = odict()
+    for name, version, as_dependency in to_install:
+        p = package_data[name][version]
+        for t in p['type']:
+            for target, f in handlers[t]().targets(p, p['files']).items():
+                claims.setdefault((t, target), odict())[name] = f[FileInfo.hash_key]
+    by_type = odict()
+    for t, target in claims:
+        by_type.setdefault(t, []).append(target)
+    #targets of installed owners, what they recorded
+    installed_targets = {}
+    for t, targets in by_type.items():
+        for target, names in installed_packages.owners(t, targets).items():
+            for n in names:
+                if n in claims[(t, target)]:
+                    continue
+                if (n, t) not in installed_targets:
+                    pkg = installed_packages.package(n)
+                    installed_targets[(n, t)] = handlers[t]().targets(pkg, pkg['files'])
+                f = installed_targets[(n, t)].get(target)
+                claims[(t, target)][n] = f[FileInfo.hash_key] if f else None
+    conflicts = []
+    skip = odict()
+    for (t, target), names in claims.items():
+        if len(set(names.values())) > 1:
+            conflicts.append('%s (%s)' % (target, ', '.join(names)))
+        elif len(names) > 1:
+            for n in [n for n in names if n in package_data][1:]:
+                skip.setdefault((n, t), set()).add(target)
+    if conflicts:
+        if not force:
+            raise Exception('File conflicts: %s' % '; '.join(conflicts))
+        for c in conflicts:
+            warn('overwriting %s' % c)
+    return skip
+
+def install(args, package_data, repo_data):
+    import semver
+    from resolver import Resolver
+    installed_packages = load_installed_state()
+    packages = args.packages
+    for name in packages:
+        if name not in package_data:
+            raise Exception('No such package: ' + name)
+    with span('resolve'):
+        resolution = Resolver(package_data, installed_packages).resolve([(name, '') for name in packages], packages)
+
+    to_install = []
+    #(dep, required_by, range) for deps that are already installed at the resolved version
+    new_edges = []
+    for name, (version, as_dependency) in resolution.items():
+        if name in installed_packages:
+            instversion = installed_packages.version(name)
+            if name in packages and semver.compare(instversion, version) != -1:
+                raise Exception('Package %s already installed at version %s (trying: %s)' %  (name, instversion, version))
+            if instversion == version:
+                new_edges += [(name, by, r) for by, r in as_dependency]
+                continue
+        to_install.append((name, version, as_dependency))
+    print('installing %s.' % to_install)
+    load_files(package_data, [package_data[name][version] for name, version, as_dependency in to_install])
+    with span('file conflicts'):
+        shared = check_file_conflicts(to_install, package_data, installed_packages, args.force)
+
+    #plan: downloads and file operations, nothing is changed before --dry-run returns
+    store = object_store()
+    downloads = []
+    views = []
+    plans = []
+    #[(url, [(member, sha1)], package name, download, view, [(type, plan)], cache path)]
+    partials = []
+    for name, version, as_dependency in to_install:
+        p = package_data[name][version]
+        handler_plans = odict()
+        for t in p['type']:
+            handler = handlers[t]()
+            owned, previous = [], odict()
+            if name in installed_packages:
+                owned = installed_packages.owned(name, t)
+                state = installed_packages.handler_states(name).get(t)
+                if state is not None:
+                    #upgrade: only changed members are written and dropped ones removed,
+                    #files other packages own as well are left alone
+                    previous = handler.previous(installed_packages.package(name), state)
+                    shared = installed_packages.owners(t, previous)
+                    previous = odict([(k, v) for k, v in previous.items() if shared.get(k, [name]) == [name]])
+            with span('plan ' + t, package=name):
+                handler_plans[t] = handler.plan_install(p, p['files'], cache_path(p), args.force, set(owned), previous,
+                                                        shared.get((name, t), ()))
+        plans.append((p, as_dependency, handler_plans))
+
+        for path, f in p['files'].items():
+            sha1 = f[FileInfo.hash_key]
+            url = repo_download_url(p, path)
+            cpath = cache_path(p, path)
+            if store.has(sha1):
+                views.append((sha1, cpath))
+                continue
+            members = [(member, mf[FileInfo.hash_key], mf['size']) for t, plan in handler_plans.items()
+                       for member, mf in handlers[t]().members(plan, cpath)]
+            if f.get('subfiles') and is_url(url) and sum([m[2] for m in members]) < partial_share * f['size']:
+                partials.append((url, [m[:2] for m in members], name, (url, store.object_path(sha1), sha1, name),
+                                 (sha1, cpath), list(handler_plans.items()), cpath))
+                continue
+            views.append((sha1, cpath))
+            downloads.append((url, store.object_path(sha1), sha1, name))
+    if args.dry_run:
+        print_plan(plans, downloads, partials, package_data, installed_packages)
+        return
+
+    #fetch everything missing from the cache first, over a shared connection pool.
+    #upgrades that write a few members of a large archive fetch just those, falling
+    #back to the whole archive if the server does not support ranges
+    with span('download'):
+        downloader = download.Downloader(args.jobs)
+        for url, members, name, full, view, type_plans, cpath in partials:
+            if members:
+                try:
+                    downloader.fetch_members(url, members, store, name)
+                except FileNotFoundError as e:
+                    warn('%s, downloading all of it' % e)
+                    downloads.append(full)
+                    views.append(view)
+                    continue
+            for t, plan in type_plans:
+                handlers[t]().unpacked(plan, cpath, store)
+        downloader.fetch_all(downloads)
+        for sha1, view in views:
+            store.link(sha1, view)
+
+    #execute: files are journaled and rolled back if anything fails, the state
+    #database is committed once at the end
+    journal = []
+    try:
+        with span('execute'), installed_packages.transaction():
+            for p, as_dependency, handler_plans in plans:
+                name = p['name']
+                print('installing', name)
+                state = odict()
+                owned = odict()
+                for t, plan in handler_plans.items():
+                    handler = handlers[t]()
+                    with span('install ' + t, package=name):
+                        state[t] = handler.execute(p, plan, journal, store if args.unpacked else None,
+                                                   args.unpacked or 'auto', backup_dir=backup_dir)
+                    owned[t] = handler.owned(p, state[t])
+
+                date = datetime.datetime.now(datetime.timezone.utc).strftime(date_format)
+                with span('state', package=name):
+                    installed_packages.add(name, p['version'], date, p, state, owned)
+            for p, as_dependency, handler_plans in plans:
+                for by, r in as_dependency:
+                    installed_packages.add_dependent(p['name'], by, r)
+            for edge in new_edges:
+                installed_packages.add_dependent(*edge)
+    except BaseException:
+        log('install failed, rolling back')
+        rollback(journal)
+        raise
+    commit(journal)
+    with span('prune'):
+        store.prune()
+
+def print_plan(plans, downloads, partials, package_data, installed_packages):
+    download_sizes = {}
+    for p, as_dependency, handler_plans in plans:
+        for f in p['files'].values():
+            download_sizes[f[FileInfo.hash_key]] = f['size']
+    download_bytes = sum([download_sizes[sha1] for url, target, sha1, name in downloads])
+    total_files, total_bytes = 0, 0
+    for p, as_dependency, handler_plans in plans:
+        name = p['name']
+        action = 'install'
+        if name in installed_packages:
+            action = 'upgrade from %s' % installed_packages.version(name)
+        print('%s %s: %s' % (name, p['version'], action))
+        for t, plan in handler_plans.items():
+            nbytes = sum([f['size'] for installp, f, source, replace in plan['writes']])
+            total_files += len(plan['writes'])
+            total_bytes += nbytes
+            print('  %s: write %i files (%s), keep %i, remove %i, back up %i, %i dirs' % (
+                t, len(plan['writes']), format_size(nbytes), plan['kept'], len(plan['removes']),
+                len(plan['backups']), len(plan['dirs'])))
+    member_sizes = {}
+    for p, as_dependency, handler_plans in plans:
+        for t, plan in handler_plans.items():
+            for installp, f, source, replace in plan['writes']:
+                member_sizes[f[FileInfo.hash_key]] = f['size']
+    members = [sha1 for url, ms, name, full, view, type_plans, cpath in partials for member, sha1 in ms]
+    if partials:
+        print('fetch %i members (%s) of %i archives' % (
+            len(members), format_size(sum([member_sizes[sha1] for sha1 in members])), len(partials)))
+    print('download %i files (%s), write %i files (%s)' % (
+        len(downloads), format_size(download_bytes), total_files, format_size(total_bytes)))
+
+
+def cache(args, package_data, repo_data):
+    store = object_store()
+    if args.action == 'prune':
+        max_size = parse_size(args.max_size) if args.max_size is not None else store.max_size
+        removed, freed = store.prune(max_size)
+        log('removed %i files, freed %s' % (removed, format_size(freed)))
+    stats = store.stats()
+    for k in ['objects', 'partial', 'size', 'max_size', 'views', 'dangling', 'oldest']:
+        if k in stats:
+            v = stats[k]
+            print('%-10s %s' % (k, format_size(v) if k in ['size', 'max_size'] else v))
+
+
+
+def remove(args, package_data, repo_data):
+    installed_packages = load_installed_state()
+    packages = args.packages
+
+    for name in packages:
+        if name not in installed_packages:
+            raise Exception('Package %s is not installed' % name)
+        req_by = [n for n in installed_packages.required_by(name) if n not in packages]
+        if req_by:
+            raise Exception('Package %s is still required by %s' % (name, ', '.join(req_by)))
+
+    to_remove = list(packages)
+    if args.unneeded:
+        with span('unneeded'):
+            to_remove += installed_packages.unneeded(packages)
+    for name in to_remove:
+        state = installed_packages.handler_states(name)
+        #the package as it was installed, the index may have newer versions
+        pkg = installed_packages.package(name)
+
+        types = pkg['type']
+        for t in types:
+            handler = handlers[t]()
+            with span('remove ' + t, package=name):
+                handler.remove(pkg, state[t])
+
+
+        with span('state', package=name):
+            installed_packages.delete(name)
+
+def check(args, package_data, repo_data):
+    #quick tier compares sizes and the stat fingerprints recorded at install,
+    #--full hashes every file on a thread pool
+    from concurrent.futures import ThreadPoolExecutor
+    installed_packages = load_installed_state()
+    names = args.packages or list(installed_packages)
+    problems = []
+    to_hash = []
+    nfiles = 0
+    for name in names:
+        if name not in installed_packages:
+            raise Exception('Package %s is not installed' % name)
+        pkg = installed_packages.package(name)
+        states = installed_packages.handler_states(name)
+        for t in pkg['type']:
+            for path, install_path, pinfo, fingerprint in handlers[t]().installed_files(pkg, states[t]):
+                if FileInfo.is_dir(pinfo):
+                    continue
+                nfiles += 1
+                try:
+                    st = install_path.stat()
+                except FileNotFoundError:
+                    problems.append((name, install_path, 'missing'))
+                    continue
+                if st.st_size != pinfo['size']:
+                    problems.append((name, install_path, 'size differs'))
+                elif args.full:
+                    to_hash.append((name, t, path, install_path, pinfo, fingerprint, st))
+                elif stat_fingerprint(st) != fingerprint:
+                    problems.append((name, install_path, 'changed since install' if fingerprint else 'no fingerprint recorded'))
+
+    def verify(item):
+        name, install_path, pinfo = item[0], item[3], item[4]
+        with span('verify', package=name):
+            return hash_path(install_path) == pinfo[FileInfo.hash_key]
+
+    with ThreadPoolExecutor(args.jobs or None) as pool, installed_packages.transaction():
+        for item, ok in zip(to_hash, pool.map(verify, to_hash)):
+            name, t, path, install_path, pinfo, fingerprint, st = item
+            if not ok:
+                problems.append((name, install_path, 'hash differs'))
+            elif stat_fingerprint(st) != fingerprint:
+                #content is intact, the next quick check should not flag it again
+                installed_packages.set_fingerprint(name, t, path, stat_fingerprint(st))
+
+    for name, path, problem in problems:
+        print('%s: %s %s' % (name, path, problem))
+    log('%i packages, %i files, %i problems' % (len(names), nfiles, len(problems)))
+    if problems:
+        exit(1)
+
+def owns(args, package_data, repo_data):
+    installed_packages = load_installed_state()
+    if args.shared:
+        for t, path, names in installed_packages.shared():
+            print('%s is owned by %s' % (path, ', '.join(names)))
+    for path in args.paths:
+        owners = []
+        for t, handler in handlers.items():
+            target = handler().relative(path)
+            if target is not None:
+                owners += installed_packages.owners(t, [target]).get(target, [])
+        if not owners:
+            raise Exception('No package owns %s' % path)
+        for name in owners:
+            print('%s is owned by %s %s' % (path, name, installed_packages.version(name)))
+
+def list_packages(args, package_data, repo_data):
+    installed_packages = load_installed_state()
+    installed = list(installed_packages)
+    installed_set = set(installed)
+    preds = odict()
+    formats = []
+    if not args.all:
+        preds['installed'] = lambda p: p in installed_set
+    else:
+        formats.append(lambda p: p + ['[installed]'] if p[0] in installed_set else p)
+    if args.deps or args.explicit or args.unrequired:
+        required = installed_packages.required()
+    if args.deps:
+        preds['deps'] = lambda p: p in installed_set and p in required
+    if args.explicit or args.unrequired:
+        #without a recorded dependent a package counts as explicitly installed
+        preds['unrequired'] = lambda p: p in installed_set and p not in required
+
+    names = package_data if args.all else installed
+    if args.search:
+        #best match first
+        names = [name for name, score in package_data.search(args.search)]
+    for p in names:
+        if all([pr(p) for pr in preds.values()]):
+            s = [p]
+            for f in formats:
+                s = f(s)
+            print(*s)
+
+json_options = {'object_pairs_hook': json_pairs}
+
+def parse_json(f):
+    return json.loads(f, **json_options)
+
+def load_json(path):
+    with path.open('r') as f:
+        return json.load(f, **json_options)
+
+def load_repo(repo_path):
+    data = []
+    if not repo_path.exists():
+        log('Skipping repo ' + str(repo_path) + ', because file doesn\'t exist.')
+        return []
+    data = load_json(repo_path)
+    return data
+    
+def write_repo(repo_path, repo_data):
+    repo_path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write(repo_path) as f:
+        json.dump(repo_data, f, default=json_default)
+
+
+def repo_format(data):
+    return odict([(d['name'], d) for d in data])
+
+def write_delta(delta_path, added, repo_data, repo_files):
+    #delta: {serial, deltas: [{serial, packages: {name: {version: pkg}}, files: {...}}]}
+    #a null version removes it
+    delta = load_json(delta_path) if delta_path.exists() else odict([('serial', 0), ('deltas', [])])
+    entry = odict([('serial', delta['serial'] + 1), ('packages', odict()), ('files', odict())])
+    for name, version in added:
+        entry['packages'].setdefault(name, odict())[version] = repo_data[name][version]
+        entry['files'].setdefault(name, odict())[version] = repo_files[name][version]
+    delta['serial'] = entry['serial']
+    delta['deltas'] = (delta['deltas'] + [entry])[-max_delta_entries:]
+    write_repo(delta_path, delta)
+
+def merge_files(data, files):
+    for name, versions in files.items():
+        for version in versions:
+            data[name][version]['files'] = files[name][version]
+
+def apply_delta(data, entries, files=True):
+    #files: merge the entries' file lists, not wanted for records with manifests
+    for entry in entries:
+        for name, versions in entry['packages'].items():
+            for version, p in versions.items():
+                if p is None:
+                    data.get(name, odict()).pop(version, None)
+                    if name in data and not data[name]:
+                        del data[name]
+                    continue
+                data.setdefault(name, odict())[version] = p
+        for name, versions in (entry.get('files', odict()) if files else {}).items():
+            for version, f in versions.items():
+                if f is not None and name in data and version in data[name]:
+                    data[name][version]['files'] = f
+    for name, versions in data.items():
+        data[name] = odict(sorted(versions.items(), key=lambda t: t[0]))
+    return data
+
+async def fetch_conditional(limiter, url, validator=None):
+    return await limiter.call(url, get_uri_conditional, url, validator, False, limiter.timeout)
+
+async def update_repo_delta(repo_path, durl, meta, limiter, files=True):
+    #returns (data, changed), or None if a full fetch is needed. either way
+    #meta['serial'] is where the fetched deltas end
+    validators = meta.setdefault('validators', odict())
+    serial = meta.get('serial') if repo_path.exists() else None
+    content, validators[durl] = await fetch_conditional(limiter, durl, validators.get(durl) if serial is not None else None)
+    if content is None:
+        log('%s is unchanged' % durl)
+        return load_repo(repo_path), False
+    delta = parse_json(content)
+    meta['serial'] = delta['serial']
+    if serial is None:
+        return None
+    entries = [e for e in delta['deltas'] if e['serial'] > serial]
+    if entries and entries[0]['serial'] != serial + 1:
+        #too old for the published deltas
+        return None
+    if not entries:
+        return load_repo(repo_path), False
+    log('applying %i delta(s) to %s' % (len(entries), repo_path))
+    return apply_delta(load_repo(repo_path), entries, files), True
+
+async def update_mirror(repo_path, mirror, meta, limiter):
+    #returns (data, changed)
+    import asyncio
+    validators = meta.setdefault('validators', odict())
+    url, furl = mirror[:2]
+    durl = mirror[2] if len(mirror) > 2 else None
+    if durl:
+        r = await update_repo_delta(repo_path, durl, meta, limiter, furl is not None)
+        if r is not None:
+            return r
+
+    local = repo_path.exists()
+    if furl is None:
+        #file lists are loaded from the manifests when needed
+        r, validators[url] = await fetch_conditional(limiter, url, validators.get(url) if local else None)
+        if r is None:
+            log('%s is unchanged' % url)
+            return load_repo(repo_path), False
+        return parse_json(r), True
+    (r, rv), (fr, frv) = await asyncio.gather(
+        fetch_conditional(limiter, url, validators.get(url) if local else None),
+        fetch_conditional(limiter, furl, validators.get(furl) if local else None))
+    if r is None and fr is None:
+        log('%s is unchanged' % url)
+        return load_repo(repo_path), False
+    if r is None:
+        r, rv = await fetch_conditional(limiter, url)
+    if fr is None:
+        fr, frv = await fetch_conditional(limiter, furl)
+    validators[url], validators[furl] = rv, frv
+    data = parse_json(r)
+    merge_files(data, parse_json(fr))
+    return data, True
+
+async def update_repo(repo_path, repo_files_path, urls, meta, limiter):
+    #races the mirrors, see download.race. each one works on its own copy of meta,
+    #the winner's replaces it
+    def attempt(mirror):
+        async def run():
+            m = copy.deepcopy(meta)
+            return await update_mirror(repo_path, mirror, m, limiter) + (m,)
+        return run
+    try:
+        data, changed, m = await download.race([attempt(mirror) for mirror in urls],
+                                               (FileNotFoundError, ValueError) + download.retry_errors())
+    except (FileNotFoundError, ValueError) + download.retry_errors() as e:
+        raise Exception('Could not load remote repository: %s (%s)' % (', '.join([str(m) for m in urls]), e))
+    meta.clear()
+    meta.update(m)
+    return data, changed
+
+async def update_repos_(repositories, limiter):
+    import asyncio
+    async def update(repo, urls):
+        path = repo_filepath(repo)
+        meta_path = repo_meta_path(repo)
+        meta = load_json(meta_path) if meta_path.exists() else odict()
+        with span('update repo', repo=repo):
+            data, changed = await update_repo(path, repo_files_path(repo), urls, meta, limiter)
+        if changed:
+            write_repo(path, data)
+        write_repo(meta_path, meta)
+        return data
+    results = await asyncio.gather(*[update(repo, urls) for repo, urls in repositories.items()])
+    return odict(zip(repositories, results))
+
+def update_repos(repositories):
+    #all repositories at once, requests run in threads limited per host. asyncio is
+    #imported here, it is slow to import for the commands that never update
+    import asyncio
+    limiter = download.HostLimiter()
+    try:
+        return asyncio.run(update_repos_(repositories, limiter))
+    finally:
+        limiter.close()
+
+def load_repos(repos):
+    repo_data = {}
+    paths = [repo_filepath(r) for r in repos]
+    data = [load_repo(p) for p in paths]
+    return odict(zip(repos.keys(), data))
+
+def repo_index_path():
+    return repos_filepath / repo_index_name
+
+def load_package_index(repos, repo_data=None):
+    #rebuilt only if stale. repo_data: the repos as just updated, saves loading them again
+    db_path = repo_index_path()
+    if repodb.is_stale(db_path, odict([(r, repo_filepath(r)) for r in repos])):
+        log('Compiling package index %s' % db_path)
+        with span('build index'):
+            repodb.build(db_path, repo_data if repo_data is not None else load_repos(repos))
+    return repodb.PackageIndex(db_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="A plugin/handler based package manager")
+    parser.add_argument('--update', '-y', action='store_true', help="Update package lists.")
+    parser.add_argument('--profile', action='store_true', help="Print time, downloaded, hashed and written bytes per phase and package")
+    parser.add_argument('--trace-json', type=Path, metavar='FILE', help="Write a Chrome trace (chrome://tracing, Perfetto) of all phases")
+
+    subparsers = parser.add_subparsers(help='sub-command help')
+    add_p = subparsers.add_parser('add', help='Add something to the package index')
+    add_p.add_argument('--repo', '-r', help="Repository file to add package to")
+    add_p.add_argument('paths', nargs='+', help="A directory with the files for each package",type=Path)
+    add_p.add_argument('--force', '-f', action='store_true', help="Force updating of package")
+    add_p.add_argument('--jobs', '-j', type=int, default=1, help="Hash files in N processes (0: one per cpu)")
+    add_p.add_argument('--rehash', action='store_true', help="Ignore the hash cache and hash all files again")
+    add_p.set_defaults(func=add)
+    install_p = subparsers.add_parser('install', help='install a package')
+    install_p.add_argument('packages', nargs='+', help="Packages to work on.")
+    install_p.add_argument('--force', '-f', action='store_true', help="Force overwriting of existing files")
+    install_p.add_argument('--jobs', '-j', type=int, default=download.default_jobs, help="Number of parallel downloads")
+    install_p.add_argument('--unpacked', '-u', choices=list(link_modes), default=os.environ.get('GPM_UNPACKED') or None,
+                           help="Unpack archives into the cache once and link or copy files from there (default $GPM_UNPACKED)")
+    install_p.add_argument('--dry-run', '-n', action='store_true', help="Print what would be downloaded and written")
+    install_p.set_defaults(func=install)
+
+    remove_p = subparsers.add_parser('remove', help='Remove a package')
+    remove_p.add_argument('packages', nargs='+', help="Packages to work on.")
+    remove_p.set_defaults(func=remove)
+    #  remove_p.add_argument('-b', '--dbpath', help='set an alternate database location', action='store_true')
+    #  remove_p.add_argument('-c', '--cascade', help='remove packages and all packages that depend on them', action='store_true')
+    #  remove_p.add_argument('-d', '--nodeps', help='skip dependency version checks (-dd to skip all checks)', action='store_true')
+    #  remove_p.add_argument('-n', '--nosave', help='remove configuration files', action='store_true')
+    #  remove_p.add_argument('-p', '--print', help='print the targets instead of performing the operation', action='store_true')
+    #  remove_p.add_argument('-r', '--root', help='set an alternate installation root', action='store_true')
+    #  remove_p.add_argument('-s', '--recursive', help='remove unnecessary dependencies', action='store_true')
+    #  remove_p.add_argument('-ss', '--recursive', help='also remove explicitly installed dependencies', action='store_true')
+    remove_p.add_argument('--unneeded', '-u', help='remove unneeded packages', action='store_true')
+    
+    cache_p = subparsers.add_parser('cache', help='Inspect or prune the download cache')
+    cache_p.add_argument('action', choices=['stats', 'prune'], help="Show cache usage or evict least recently used files")
+    cache_p.add_argument('--max-size', '-s', help="Prune down to this size (e.g. 500M, 2G), default $GPM_CACHE_MAX_SIZE or 4G")
+    cache_p.set_defaults(func=cache)
+
+    check_p = subparsers.add_parser('check', help='Check that installed files are unchanged')
+    check_p.add_argument('packages', nargs='*', help="Packages to check, default all installed")
+    check_p.add_argument('--full', '-k', action='store_true', help="Compare hashes instead of size and stat fingerprints")
+    check_p.add_argument('--jobs', '-j', type=int, default=0, help="Hash files in N threads (0: one per cpu)")
+    check_p.set_defaults(func=check)
+
+    owns_p = subparsers.add_parser('owns', help='Query the package that owns a file')
+    owns_p.add_argument('paths', nargs='*', help="Paths relative to the game directory or absolute")
+    owns_p.add_argument('--shared', '-s', action='store_true', help="List files owned by more than one package")
+    owns_p.set_defaults(func=owns)
+
+    list_p = subparsers.add_parser('list', help='List packages in the index')
+
+    list_p.add_argument('--all', '-a', action='store_true', help="List all packages instead of only installed")
+    list_p.add_argument('-d', '--deps', help='list packages installed as dependencies [filter]', action='store_true')
+    list_p.add_argument('-e', '--explicit', help='list packages explicitly installed [filter]', action='store_true')
+#    list_p.add_argument('-g', '--groups', help='view all members of a package group', action='store_true')
+#    list_p.add_argument('-i', '--info', help='view package information (-ii for backup files)', action='store_true')
+#    list_p.add_argument('-l', '--list', help='list the files owned by the queried package', action='store_true')
+#    list_p.add_argument('-m', '--foreign', help='list installed packages not found in sync db(s) [filter]', action='store_true')
+#    list_p.add_argument('-n', '--native', help='list installed packages only found in sync db(s) [filter]', action='store_true')
+#    list_p.add_argument('-p', '--file', help='query a package file instead of the database')
+#    list_p.add_argument('-q', '--quiet', help='show less information for query and search')
+#    list_p.add_argument('-r', '--root', help='set an alternate installation root')
+    list_p.add_argument('-s', '--search', help='search installed packages (with --all: every package) by name, title, keywords, author and description, words match as prefixes')
+    list_p.add_argument('-t', '--unrequired', help='list packages not required by any installed package [filter]', action='store_true')
+#    list_p.add_argument('-u', '--upgrades', help='list outdated packages [filter]')
+  
+    list_p.set_defaults(func=list_packages)
+    
+    args = parser.parse_args()
+    if args.profile or args.trace_json:
+        instrument.enable()
+    try:
+        run(parser, args)
+    finally:
+        instrument.report(args.profile, args.trace_json)
+
+def run(parser, args):
+    if args.update:
+        repos_filepath.mkdir(parents=True, exist_ok=True)
+
+        repo_data = update_repos(repositories)
+        package_data = load_package_index(repositories, repo_data)
+    else:
+        repo_data = repodb.LazyRepos(repositories, lambda r: load_repo(repo_filepath(r)))
+        #opened (and rebuilt if stale) only by commands that look packages up
+        package_data = repodb.Deferred(lambda: load_package_index(repositories))
+
+    if 'func' not in args:
+        parser.print_help()
+        exit(1)
+    args.func(args, package_data, repo_data)
+    
+
+
+if __name__ == '__main__':
+    main()
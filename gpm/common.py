@@ -1,4 +1,12 @@
+import os
+import sys
 import hashlib
+import shutil
+import threading
+from collections import OrderedDict as odict
+from contextlib import contextmanager
+
+import instrument
 
 def log(msg):
     print(msg)
@@ -7,23 +15,245 @@ def warn(msg):
     print('WARNING:', msg)
 
 
+#algorithms computed by default, sha1 is what the repo indexes store
+hash_algorithms = ('sha1',)
+#read buffer, memory use of hashing stays at this regardless of file size
+hash_bufsize = 1 << 20
+
+class Hasher:
+    def __init__(self, algorithms=hash_algorithms):
+        self.hashes = [(a, hashlib.new(a)) for a in algorithms]
+        self.size = 0
+
+    def update(self, data):
+        for a, h in self.hashes:
+            h.update(data)
+        self.size += len(data)
+
+    def hexdigest(self, algorithm=None):
+        if algorithm is None:
+            algorithm = self.hashes[0][0]
+        return dict(self.hashes)[algorithm].hexdigest()
+
+    def digests(self):
+        r = dict([(a, h.hexdigest()) for a, h in self.hashes])
+        r['size'] = self.size
+        return r
+
+
+def hash_stream(f, algorithms=hash_algorithms, bufsize=hash_bufsize):
+    hasher = Hasher(algorithms)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    readinto = getattr(f, 'readinto', None)
+    while True:
+        if readinto:
+            n = readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+        else:
+            chunk = f.read(bufsize)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    instrument.count('hashed', hasher.size)
+    return hasher
+
+def hash_path_multi(path, algorithms=hash_algorithms):
+    with path.open('rb', buffering=0) as f:
+        return hash_stream(f, algorithms).digests()
 
 def hash_path(path):
-    with path.open('rb') as f:
+    with path.open('rb', buffering=0) as f:
         return hash_file(f)
 
 def hash_file(f):
-    hash = hashlib.sha1()
-    #todo read chunks
-    hash.update(f.read())
-    return hash.hexdigest()
+    return hash_stream(f).hexdigest(FileInfo.hash_key)
+
+
+
+#suffix of files being written before they are moved into place
+tmp_ext = '.gpm-tmp'
+
+def tmp_path(path):
+    #unique per process and thread, so it is not a file of a package, like a zip
+    #member named <path>.tmp, nor the temp file of another write
+    return path.with_name('.%s.%i.%i%s' % (path.name, os.getpid(), threading.get_ident(), tmp_ext))
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    #readers see the old file or the complete new one, never a partial write. the
+    #temp file is opened exclusively, it never clobbers another file
+    tmp = tmp_path(path)
+    f = tmp.open(mode.replace('w', 'x'))
+    try:
+        with f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        tmp.unlink()
+        raise
+    os.replace(str(tmp), str(path))
+
+
+#files replaced by an install are kept next to the new one with this suffix until it commits
+old_ext = '.gpm-old'
+
+#journal entries, appended while an install changes files:
+#('dir', path) created, ('file', path) written, ('replace', path, old) path moved to old
+#before writing, ('backup', path, backup) path moved to backup
+
+def make_dirs(path, journal):
+    missing = []
+    while not path.is_dir():
+        missing.append(path)
+        path = path.parent
+    for d in reversed(missing):
+        log('creating dir %s' % d)
+        d.mkdir()
+        journal.append(('dir', d))
+
+def rollback(journal):
+    for entry in reversed(journal):
+        kind, path = entry[0], entry[1]
+        try:
+            if kind == 'file':
+                if path.exists():
+                    path.unlink()
+            elif kind == 'replace':
+                os.replace(str(entry[2]), str(path))
+            elif kind == 'backup':
+                shutil.move(str(entry[2]), str(path))
+            elif kind == 'dir' and not any(path.iterdir()):
+                path.rmdir()
+        except OSError as e:
+            warn('could not roll back %s: %s' % (path, e))
+    del journal[:]
+
+def commit(journal):
+    #'rmdir' entries are directories to remove once they are empty, after the
+    #replaced files in them are gone
+    for entry in journal:
+        if entry[0] == 'replace' and entry[2].exists():
+            entry[2].unlink()
+    for entry in journal:
+        if entry[0] == 'rmdir' and entry[1].is_dir() and not any(entry[1].iterdir()):
+            log('removing dir %s' % entry[1])
+            entry[1].rmdir()
+    del journal[:]
 
 
+def stat_fingerprint(stat):
+    #changes whenever a file is rewritten, replaced or touched
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
 
 class FileInfo:
+    #a file or container member as the repo indexes describe it: size, raw sha1 digest
+    #(None for directories) and for containers subfiles, path -> FileInfo. reads like
+    #the json dict it is loaded from, a fraction of the memory for large archives
     hash_key = 'sha1'
-    
+    __slots__ = ['size', 'digest', 'subfiles']
+
+    def __init__(self, size, digest=None, subfiles=None):
+        self.size = size
+        self.digest = digest
+        self.subfiles = subfiles
+
     @staticmethod
     def is_dir(pinfo):
         return pinfo['size'] == 0
 
+    def keys(self):
+        r = [self.hash_key] if self.digest is not None else []
+        r.append('size')
+        if self.subfiles is not None:
+            r.append('subfiles')
+        return r
+
+    def __getitem__(self, key):
+        if key == 'size':
+            return self.size
+        if key == self.hash_key and self.digest is not None:
+            return self.digest.hex()
+        if key == 'subfiles' and self.subfiles is not None:
+            return self.subfiles
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items()) if hasattr(other, 'items') else NotImplemented
+
+    def __repr__(self):
+        return 'FileInfo(%r)' % dict(self.items())
+
+    def json(self):
+        return odict(self.items())
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        #None if pairs are not a file info. runs for every object of an index, so no
+        #intermediate dict
+        if not 0 < len(pairs) <= 3:
+            return None
+        size = sha1 = subfiles = None
+        for k, v in pairs:
+            if k == 'size' and size is None and type(v) is int:
+                size = v
+            elif k == cls.hash_key and sha1 is None and type(v) is str and len(v) == 40:
+                sha1 = v
+            elif k == 'subfiles' and subfiles is None and isinstance(v, dict):
+                subfiles = v
+            else:
+                return None
+        if size is None:
+            return None
+        if pairs[0][0] == 'size':
+            cls = MemberInfo
+        return cls(size, bytes.fromhex(sha1) if sha1 is not None else None, subfiles)
+
+
+class MemberInfo(FileInfo):
+    #container members are written size first, this keeps their order so a loaded
+    #index dumps back byte for byte
+    __slots__ = []
+
+    def keys(self):
+        r = ['size']
+        if self.digest is not None:
+            r.append(self.hash_key)
+        if self.subfiles is not None:
+            r.append('subfiles')
+        return r
+
+file_info_keys = [FileInfo.hash_key, 'size', 'subfiles']
+
+
+def json_pairs(pairs):
+    #object_pairs_hook for repo indexes and manifests: file infos become FileInfo,
+    #maps of them plain dicts with interned paths, everything else an odict
+    info = FileInfo.from_pairs(pairs)
+    if info is not None:
+        return info
+    if pairs and isinstance(pairs[0][1], FileInfo) and all([isinstance(v, FileInfo) for k, v in pairs]):
+        return dict([(sys.intern(k), v) for k, v in pairs])
+    return odict(pairs)
+
+def json_default(o):
+    #default for json.dump of data holding FileInfo
+    if isinstance(o, FileInfo):
+        return o.json()
+    raise TypeError('%r is not JSON serializable' % o)
@@ -0,0 +1,293 @@
+import io
+import os
+from pathlib import Path
+from urllib.parse import urlparse
+
+#requests is imported when the first session is made, it dominates startup time
+#of commands that never download anything
+
+from common import log, Hasher, FileInfo, hash_stream
+import instrument
+
+file_prot = 'file://'
+default_jobs = 4
+chunk_size = 1 << 16
+#attempts per file, each one resumes where the last one stopped
+retries = 3
+part_ext = '.part'
+#--update: requests in flight per host, seconds before a request is given up on
+host_limit = 4
+timeout = float(os.environ.get('GPM_TIMEOUT', '30'))
+#a mirror that has not answered after this long gets the next one started alongside it
+mirror_stagger = 1.0
+#remote zips: the first request fetches the tail, enough for the end of central
+#directory record with the longest comment and usually the whole directory. later
+#ones fetch at least a block
+range_tail = 128 << 10
+range_block = 256 << 10
+
+def is_url(url):
+    #todo better support file://
+    return not url.startswith(file_prot)
+
+def uri2path(uri):
+    return Path(uri[len(file_prot):])
+
+
+def host(url):
+    #'' for local files, they share one limit
+    return urlparse(url).netloc if is_url(url) else ''
+
+
+def make_session(jobs=default_jobs):
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def retry_errors():
+    import requests
+    return (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+_session = None
+def session():
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+
+class RangeFile(io.RawIOBase):
+    #read only, seekable file over http range requests, for ZipFile. keeps the last
+    #block fetched. raises FileNotFoundError if the server ignores ranges
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url
+        self.name = url
+        self.pos = 0
+        start, self.size, data = self.get('-%i' % range_tail)
+        self.block = (start, data)
+
+    def get(self, spec):
+        #returns (start, total size, data)
+        r = self.session.get(self.url, headers={'Range': 'bytes=' + spec}, stream=True, timeout=timeout)
+        with r:
+            if r.status_code != 206:
+                raise FileNotFoundError('No range support: %i (%s)' % (r.status_code, self.url))
+            #bytes <start>-<end>/<total>
+            range_, total = r.headers.get('Content-Range', '').split(' ')[-1].split('/')
+            data = r.content
+        instrument.count('downloaded', len(data))
+        return int(range_.split('-')[0]), int(total), data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.pos = [offset, self.pos + offset, self.size + offset][whence]
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        start, data = self.block
+        if not (start <= self.pos and self.pos + n <= start + len(data)):
+            end = min(self.size, self.pos + max(n, range_block))
+            start, size, data = self.get('%i-%i' % (self.pos, end - 1))
+            self.block = (start, data)
+        i = self.pos - start
+        b[:n] = data[i:i + n]
+        self.pos += n
+        return n
+
+
+class Downloader:
+    def __init__(self, jobs=default_jobs, session=None):
+        self.jobs = jobs
+        self.session = session or make_session(jobs)
+
+    def open(self, url, offset=0):
+        #returns (offset, chunks) where offset is where the body actually starts,
+        #which is 0 if the server ignored the range
+        if is_url(url):
+            headers = {'Range': 'bytes=%i-' % offset} if offset else {}
+            r = self.session.get(url, stream=True, headers=headers)
+            if r.status_code == 416 and offset:
+                #nothing left to fetch
+                r.close()
+                return offset, iter(())
+            if r.status_code == 206:
+                start = r.headers.get('Content-Range', '').split(' ')[-1].split('-')[0]
+                if start != str(offset):
+                    r.close()
+                    raise FileNotFoundError('Bad range response: %s (%s)' % (r.headers.get('Content-Range'), url))
+            elif r.status_code == 200:
+                offset = 0
+            else:
+                r.close()
+                raise FileNotFoundError('Could not download file: %i (%s)' % (r.status_code, url))
+            def chunks():
+                with r:
+                    for chunk in r.iter_content(chunk_size):
+                        yield chunk
+            return offset, chunks()
+        def chunks():
+            with uri2path(url).open('rb') as fd:
+                fd.seek(offset)
+                for chunk in iter(lambda: fd.read(chunk_size), b''):
+                    yield chunk
+        return offset, chunks()
+
+    @staticmethod
+    def part_path(target):
+        return target.with_name(target.name + part_ext)
+
+    def fetch(self, url, target, sha1, package=None):
+        #streams url into target.part, resuming a partial file left by an earlier run,
+        #and moves it into place only if the hash matches
+        with instrument.span('fetch', package=package, url=url):
+            return self.fetch_(url, target, sha1)
+
+    def fetch_(self, url, target, sha1):
+        log('Downloading %s...' % url)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        part = self.part_path(target)
+        hasher = Hasher((FileInfo.hash_key,))
+        if part.exists():
+            #hashed once here, later retries in this run keep the hasher going
+            with part.open('rb') as f:
+                hasher = hash_stream(f, (FileInfo.hash_key,))
+            log('Resuming %s at %i bytes' % (url, hasher.size))
+
+        for attempt in range(retries):
+            try:
+                offset, chunks = self.open(url, hasher.size)
+                if offset != hasher.size:
+                    #server sent the whole file
+                    hasher = Hasher((FileInfo.hash_key,))
+                with part.open('r+b' if offset else 'wb') as f:
+                    f.seek(offset)
+                    f.truncate()
+                    for chunk in chunks:
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        instrument.count('downloaded', len(chunk))
+                        instrument.count('hashed', len(chunk))
+                break
+            except retry_errors() as e:
+                if attempt + 1 == retries:
+                    raise
+                #hasher.size may be ahead of what reached the disk if the write failed
+                hasher = self.rehash_if_short(part, hasher)
+                log('Retrying %s at %i bytes (%s)' % (url, hasher.size, e))
+
+        if hasher.hexdigest() != sha1:
+            part.unlink()
+            raise Exception('Download for %s was broken (failed hash).' % url)
+        part.replace(target)
+        return target
+
+    def fetch_members(self, url, members, store, package=None):
+        #members: [(member, sha1)] of the zip at url, unpacked into store and verified
+        #there without downloading the rest of the archive
+        from zipfile import ZipFile
+        with instrument.span('fetch members', package=package, url=url):
+            log('Fetching %i members of %s...' % (len(members), url))
+            f = RangeFile(self.session, url) if is_url(url) else uri2path(url).open('rb')
+            with f, ZipFile(f) as zf:
+                return [store.unpack(zf, member, sha1) for member, sha1 in members]
+
+    @staticmethod
+    def rehash_if_short(part, hasher):
+        if part.exists() and part.stat().st_size == hasher.size:
+            return hasher
+        if not part.exists():
+            return Hasher((FileInfo.hash_key,))
+        with part.open('rb') as f:
+            return hash_stream(f, (FileInfo.hash_key,))
+
+    def fetch_all(self, downloads):
+        #downloads: [(url, target, sha1[, package])], raises the first error after all fetches finished
+        unique = []
+        seen = set()
+        for d in downloads:
+            if d[1] not in seen:
+                seen.add(d[1])
+                unique.append(d)
+        downloads = unique
+        if not downloads:
+            return []
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.jobs) as pool:
+            futures = [pool.submit(self.fetch, *d) for d in downloads]
+        errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            raise errors[0]
+        return [f.result() for f in futures]
+
+
+class HostLimiter:
+    #runs blocking calls for asyncio in its own threads, at most limit at a time per
+    #host. a call that takes longer than timeout raises FileNotFoundError, its thread
+    #is abandoned and finishes in the background
+    def __init__(self, limit=None, timeout=None, jobs=16):
+        from concurrent.futures import ThreadPoolExecutor
+        self.limit = limit or host_limit
+        self.timeout = timeout or globals()['timeout']
+        self.pool = ThreadPoolExecutor(jobs)
+        #made on first use, semaphores belong to the running loop
+        self.semaphores = {}
+
+    async def call(self, url, func, *args):
+        import asyncio
+        h = host(url)
+        if h not in self.semaphores:
+            self.semaphores[h] = asyncio.Semaphore(self.limit)
+        async with self.semaphores[h]:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                raise FileNotFoundError('Timed out after %gs (%s)' % (self.timeout, url))
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+async def race(attempts, errors, stagger=None):
+    #attempts: coroutine functions started in order, each one when the one before it
+    #failed or has not finished within stagger seconds. returns the first result and
+    #cancels the rest. exceptions in errors count as a failed attempt, the last one is
+    #raised if all of them failed, anything else is raised right away
+    import asyncio
+    stagger = mirror_stagger if stagger is None else stagger
+    attempts = list(attempts)
+    pending = set()
+    failed = []
+    try:
+        while attempts or pending:
+            if attempts:
+                pending.add(asyncio.ensure_future(attempts.pop(0)()))
+            done, pending = await asyncio.wait(pending, timeout=stagger if attempts else None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                e = t.exception()
+                if e is None:
+                    return t.result()
+                if not isinstance(e, errors):
+                    raise e
+                failed.append(e)
+    finally:
+        for t in pending:
+            t.cancel()
+    raise failed[-1]
@@ -0,0 +1,176 @@
+import os
+import json
+from collections import OrderedDict as odict
+from concurrent.futures import Future
+from zipfile import ZipFile
+
+from common import FileInfo, hash_file, hash_path_multi, stat_fingerprint
+import instrument
+
+#zip members are hashed in batches of about this many uncompressed bytes,
+#bigger members get a batch of their own
+member_batch_size = 32 << 20
+
+def is_container(f):
+    #todo support more
+    return f.suffix == '.zip'
+
+
+class SerialPool:
+    def __init__(self, jobs=1):
+        pass
+
+    def submit(self, fn, *args):
+        f = Future()
+        try:
+            f.set_result(fn(*args))
+        except BaseException as e:
+            f.set_exception(e)
+        return f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def make_pool(jobs):
+    if jobs is not None and jobs < 1:
+        jobs = os.cpu_count()
+    if not jobs or jobs == 1:
+        return SerialPool()
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(jobs)
+
+
+def hash_members(path, names):
+    with ZipFile(str(path), 'r') as zf:
+        r = []
+        for name in names:
+            with zf.open(name, 'r') as f:
+                r.append(hash_file(f))
+        return r
+
+def member_batches(infos):
+    batches = []
+    batch, batch_size = [], 0
+    for info in infos:
+        #directories excluded
+        if info.file_size <= 0:
+            continue
+        batch.append(info.filename)
+        batch_size += info.file_size
+        if batch_size >= member_batch_size:
+            batches.append(batch)
+            batch, batch_size = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+def submit_container(pool, path):
+    with ZipFile(str(path), 'r') as zf:
+        infos = zf.filelist
+    batches = member_batches(infos)
+    return infos, [(batch, pool.submit(hash_members, path, batch)) for batch in batches]
+
+def collect_container(infos, batches):
+    hashes = {}
+    for batch, fut in batches:
+        hashes.update(zip(batch, fut.result()))
+    files = odict()
+    for info in infos:
+        r = odict()
+        r['size'] = info.file_size
+        if info.file_size > 0:
+            r[FileInfo.hash_key] = hashes[info.filename]
+        files[info.filename] = r
+    return files
+
+class HashCache:
+    #file infos keyed by absolute path, only valid while size, mtime and inode match
+    def __init__(self, path):
+        self.path = path
+        self.entries = odict()
+        self.changed = False
+        if path.exists():
+            with path.open('r') as f:
+                self.entries = json.load(f, object_pairs_hook=odict)
+
+    @staticmethod
+    def key(path):
+        return str(path.resolve())
+
+    fingerprint = staticmethod(stat_fingerprint)
+
+    def get(self, path, stat=None):
+        entry = self.entries.get(self.key(path))
+        if entry is None:
+            return None
+        if stat is None:
+            stat = path.stat()
+        if entry['stat'] != self.fingerprint(stat):
+            return None
+        return entry['info']
+
+    def put(self, path, info, stat=None):
+        if stat is None:
+            stat = path.stat()
+        self.entries[self.key(path)] = odict([('stat', self.fingerprint(stat)), ('info', info)])
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + '.tmp')
+        with tmp.open('w') as f:
+            json.dump(self.entries, f)
+        tmp.replace(self.path)
+        self.changed = False
+
+
+def container_fileinfos(path, pool=None, cache=None):
+    with instrument.span('container_fileinfos', path=path):
+        return container_fileinfos_(path, pool, cache)
+
+def container_fileinfos_(path, pool=None, cache=None):
+    if cache is not None:
+        info = cache.get(path)
+        if info is not None and 'subfiles' in info:
+            return info['subfiles']
+    if pool is None:
+        pool = SerialPool()
+    return collect_container(*submit_container(pool, path))
+
+
+def file_infos(paths, jobs=1, cache=None):
+    #hashes all paths and container members, results are in the order of paths
+    #and independent of jobs. unchanged files are taken from cache if given
+    with make_pool(jobs) as pool:
+        pending = []
+        for path in paths:
+            stat = path.stat()
+            cached = cache.get(path, stat) if cache is not None else None
+            if cached is not None:
+                pending.append((cached, None, None, None))
+                continue
+            fut = pool.submit(hash_path_multi, path)
+            container = submit_container(pool, path) if is_container(path) else None
+            pending.append((None, fut, container, (path, stat)))
+
+        infos = []
+        for cached, fut, container, path_stat in pending:
+            if cached is not None:
+                infos.append(cached)
+                continue
+            digests = fut.result()
+            r = odict()
+            r[FileInfo.hash_key] = digests[FileInfo.hash_key]
+            r['size'] = digests['size']
+            if container:
+                r['subfiles'] = collect_container(*container)
+            if cache is not None:
+                path, stat = path_stat
+                cache.put(path, r, stat)
+            infos.append(r)
+        return infos
@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict as odict
+from contextlib import contextmanager
+
+#phase timings and counters for --profile and --trace-json. everything is a no-op
+#until enable(), after that a span costs two perf_counter calls and an append.
+#work done in other processes (add --jobs) is not seen. common uses this module,
+#so gpm modules are only imported when reporting
+
+counter_names = ['downloaded', 'hashed', 'written', 'files']
+
+enabled = False
+t0 = 0
+#finished spans, in the order they ended
+spans = []
+#counts made outside of any span
+loose = {}
+local = threading.local()
+
+class Span:
+    __slots__ = ['name', 'package', 'own', 'args', 'counters', 'start', 'end', 'tid']
+
+    def __init__(self, name, package, own, args):
+        self.name = name
+        self.package = package
+        #package given to this span, not inherited from the enclosing one
+        self.own = own
+        self.args = args
+        self.counters = {}
+
+
+def enable():
+    global enabled, t0
+    enabled = True
+    t0 = time.perf_counter()
+
+@contextmanager
+def span(name, package=None, **args):
+    #times the block. counts made inside it are added to this span, nested spans
+    #in the same thread inherit package
+    if not enabled:
+        yield
+        return
+    stack = local.__dict__.setdefault('stack', [])
+    own = package is not None
+    if not own and stack:
+        package = stack[-1].package
+    s = Span(name, package, own, args)
+    stack.append(s)
+    s.start = time.perf_counter()
+    try:
+        yield s
+    finally:
+        s.end = time.perf_counter()
+        s.tid = threading.get_ident()
+        #not pop(), spans of coroutines on one thread do not end in order
+        stack.remove(s)
+        spans.append(s)
+
+def count(counter, n=1):
+    if not enabled:
+        return
+    stack = getattr(local, 'stack', None)
+    counters = stack[-1].counters if stack else loose
+    counters[counter] = counters.get(counter, 0) + n
+
+
+def totals():
+    #(phases, packages): name -> odict(calls, seconds, counters...). phase seconds include
+    #nested spans, counters only what was counted directly in the phase
+    phases = odict()
+    packages = odict()
+    for s in spans:
+        p = phases.setdefault(s.name, odict([('calls', 0), ('seconds', 0.0)]))
+        p['calls'] += 1
+        p['seconds'] += s.end - s.start
+        for c, n in s.counters.items():
+            p[c] = p.get(c, 0) + n
+        if s.package is None:
+            continue
+        p = packages.setdefault(s.package, odict([('calls', 0), ('seconds', 0.0)]))
+        if s.own:
+            p['calls'] += 1
+            p['seconds'] += s.end - s.start
+        for c, n in s.counters.items():
+            p[c] = p.get(c, 0) + n
+    if loose:
+        phases['(no phase)'] = odict([('calls', 0), ('seconds', 0.0)] + list(loose.items()))
+    return phases, packages
+
+def table(title, rows):
+    from store import format_size
+    lines = ['%-28s %6s %9s %10s %10s %10s %7s' % ((title, 'calls', 'seconds') + tuple(counter_names))]
+    for name, r in rows.items():
+        cells = [format_size(r.get(c, 0)) if c != 'files' else str(r.get(c, 0)) for c in counter_names]
+        lines.append('%-28s %6i %9.3f %10s %10s %10s %7s' % ((name[:28], r['calls'], r['seconds']) + tuple(cells)))
+    return lines
+
+def summary():
+    phases, packages = totals()
+    lines = table('phase', phases)
+    if packages:
+        lines += [''] + table('package', packages)
+    lines += ['', 'total %.3f s' % (time.perf_counter() - t0)]
+    return '\n'.join(lines)
+
+def trace_events():
+    #chrome trace format (chrome://tracing, perfetto): complete events in microseconds
+    pid = os.getpid()
+    events = []
+    for s in spans:
+        args = dict([(k, str(v)) for k, v in s.args.items()])
+        args.update(s.counters)
+        if s.package is not None:
+            args['package'] = s.package
+        events.append({'name': s.name, 'ph': 'X', 'pid': pid, 'tid': s.tid,
+                       'ts': (s.start - t0) * 1e6, 'dur': (s.end - s.start) * 1e6, 'args': args})
+    return events
+
+def write_trace(path):
+    from common import atomic_write
+    with atomic_write(path) as f:
+        json.dump({'traceEvents': trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+def report(profile=False, trace_path=None):
+    if profile:
+        print(summary(), file=sys.stderr)
+    if trace_path is not None:
+        write_trace(trace_path)
@@ -1,7 +1,16 @@
 from pathlib import Path, PurePath
-from common import FileInfo, hash_path, log
-from zipfile import ZipFile
+from common import FileInfo, hash_path, log, warn, stat_fingerprint, hash_bufsize, atomic_write, make_dirs, rollback, commit, old_ext
+from store import place_file
+import instrument
+import os
 import shutil
+import stat
+import threading
+import zlib
+from collections import OrderedDict as odict
+
+#threads extracting members, decompression and file io release the gil
+extract_jobs = min(8, os.cpu_count() or 1)
 
 class QuakeBsp:
     name = 'quake-bsp'
@@ -15,6 +24,36 @@ class QuakeBsp:
 
     def get_install_path(self, basedir, path):
         return self.quake_path / basedir / path
+
+    def target(self, basedir, path):
+        #install path relative to quake_path, packages own files by it
+        return str(PurePath(basedir) / path)
+
+    def relative(self, path):
+        #target for a path given on the command line, None if outside quake_path
+        path = Path(path)
+        if path.is_absolute():
+            try:
+                return str(path.relative_to(self.quake_path))
+            except ValueError:
+                return None
+        return str(PurePath(path))
+
+    def targets(self, p, files):
+        #target -> file info of everything p installs. directories are shared
+        basedir = self.basedir(p['type'][self.name])
+        r = odict()
+        for path, f in files.items():
+            for subpath, subf in (f.get('subfiles') or {path: f}).items():
+                if not FileInfo.is_dir(subf):
+                    r[self.target(basedir, subpath)] = subf
+        return r
+
+    def owned(self, p, state):
+        #targets of the files an install wrote
+        basedir = self.basedir(p['type'][self.name])
+        written = set([self.target(basedir, path) for path in state['written']])
+        return [t for t in self.targets(p, p['files']) if t in written]
     
     def add(self, names_versions, repo_data, repo_files):
         for (name, version) in names_versions:
@@ -22,11 +61,29 @@ class QuakeBsp:
             
             for k in list(qdata.keys()):
                 if k not in self.package_keys:
-                    warn('Illegal key %s.type.%s.%s' % (data['name'], self.name, k))
+                    warn('Illegal key %s.type.%s.%s' % (name, self.name, k))
                     del (qdata[k])
                     
 
-    def install(self, p, files, cachep, force_write):
+    def install(self, p, files, cachep, force_write, owned=(), store=None, link_mode='auto', jobs=extract_jobs, backup_dir=None):
+        #plan and execute in one go, undoing everything if a file fails
+        plan = self.plan_install(p, files, cachep, force_write, owned)
+        journal = []
+        try:
+            state = self.execute(p, plan, journal, store, link_mode, jobs, backup_dir)
+        except BaseException:
+            rollback(journal)
+            raise
+        commit(journal)
+        return state
+
+    def plan_install(self, p, files, cachep, force_write, owned=(), previous={}, shared=()):
+        #decides what to write, keep, skip, remove or back up without touching anything.
+        #owned: targets the installed version of p wrote, replaced without comparing.
+        #previous: what the installed version wrote, see previous(). unchanged members
+        #it left untouched are kept without reading them, members it had and p does
+        #not are removed. shared: targets another package of the install writes with
+        #the same content, skipped
         name = p['name']
 
         subp = p['type'][self.name]
@@ -36,128 +93,264 @@ class QuakeBsp:
         #todo handle
         assert(qpath.exists())
 
-        def copy(force_write, dryrun, dlfd, path, f):
-            installp = self.get_install_path(basedir, path)
-            relp = PurePath(basedir) / path
-            def write():
-                if not dry_run:
-                    installp.parent.mkdir(parents=True, exist_ok=True)
-                    if isdir:
-                        #create dirs as well
-                        log('creating dir %s' % installp)
-                        installp.mkdir()
-                    else:
-                        #write file
-                        with installp.open('wb') as fd:
-                            log('writing %s' % installp)
-                            shutil.copyfileobj(dlfd, fd)
-                return path
-            
-            def backup():
-                bp = backup_dir / relp
-                bp.parent.mkdir(parents=True, exist_ok=True)
-                shutil.move(str(installp), str(bp))
-                
-            isdir = FileInfo.is_dir(f)
-            exists = installp.exists()
-            #check if f exists
-            if exists:
-                if isdir:
-                    if installp.is_dir():
-                        return None
-                    else:
-                        if force_write:
-                            backup()
-                        else:
-                            return 'directory %s exists' % installp
-                else:
-                    if installp.is_dir():
-                        if force_write:
-                            backup()
-                        else:
-                            return 'directory %s exists, expected file' % installp
-                    else:
-                        # and compare hash
-                        ha = hash_path(installp)
-                        if ha == f[FileInfo.hash_key]:
-                            return None
-                        else:
-                            if force_write:
-                                backup()
-                            else:
-                                return 'file %s exists with different hash' % installp
-            return write()
-        written_files = []
-        errors = []
-        dry_run = False
-        def add(r):
-            if isinstance(r, str):
-                errors.append(r)
-                dry_run = True
-            elif r is None:
-                pass
-            else:
-                written_files.append(str(r) )
+        from zipfile import ZipFile
+        #[(path, file info, (source, member, zipinfo))], paths as in the package files
+        #so remove finds them again. archives not downloaded yet have no zipinfo
+        entries = []
         for path, f in files.items():
-            if f['subfiles']:
+            if f.get('subfiles'):
                 cpath = (cachep / path)
-                #print('opening %s' % cpath)
-                with ZipFile(str(cpath), 'r') as zf:
-                    for subpath, subf in f['subfiles'].items():
-                        add(copy(force_write, dry_run, zf.open(subpath, 'r'), Path(subpath), subf))
+                zipinfos = {}
+                if cpath.exists():
+                    with ZipFile(str(cpath), 'r') as zf:
+                        zipinfos = dict([(i.filename, i) for i in zf.infolist()])
+                for subpath, subf in f['subfiles'].items():
+                    entries.append((subpath, subf, (cpath, subpath, zipinfos.get(subpath))))
             else:
-                add(copy(force_write, dry_run, Path(path), f))
-        
-        #todo handle errors
-        #print('errots: %s' % errors)
-        return {'written': written_files}
+                entries.append((path, f, (cachep / path, None, None)))
 
-    def remove(self, pkg, state):
-        written_files = state['written']
-        #print(pkg)
+        plan = odict([('basedir', basedir), ('written', []), ('kept', 0), ('backups', []), ('dirs', []), ('writes', []),
+                      ('removes', []), ('rmdirs', []), ('created', [])])
+        errors = []
+        dirs = set()
+        for path, f, source in entries:
+            installp = self.get_install_path(basedir, path)
+            target = self.target(basedir, path)
+            if target in shared:
+                continue
+            owned_target = target in owned
+            recorded = previous.get(target)
+            action = self.plan(installp, f, source[2], owned_target, recorded[1:] if recorded else None)
+            if action.startswith('error'):
+                if not force_write:
+                    errors.append(action[len('error: '):])
+                    continue
+                plan['backups'].append((installp, PurePath(basedir) / path))
+                action = 'write'
+            if action == 'skip':
+                continue
+            plan['written'].append(path)
+            if action == 'keep':
+                plan['kept'] += 1
+                continue
+            if FileInfo.is_dir(f):
+                dirs.add(installp)
+            else:
+                dirs.add(installp.parent)
+                #the previous version of an owned file is kept aside until the install commits
+                replace = owned_target and action == 'write' and installp.exists()
+                plan['writes'].append((installp, f, source, replace))
+
+        new = set([self.target(basedir, path) for path, f, source in entries])
+        for target, (installp, f, fingerprint) in previous.items():
+            if target in new:
+                continue
+            if FileInfo.is_dir(f):
+                plan['rmdirs'].append(installp)
+                #still ours if it is not empty at commit
+                plan['created'].append(target)
+                continue
+            if target not in owned or not installp.exists():
+                continue
+            if self.plan(installp, f, None, True, (f, fingerprint)) == 'keep':
+                plan['removes'].append(installp)
+            elif force_write:
+                plan['backups'].append((installp, PurePath(target)))
+            else:
+                errors.append('file %s was modified' % installp)
+        #children before their parents
+        plan['rmdirs'].sort(reverse=True)
+        if errors:
+            raise Exception('Cannot install %s: %s' % (name, '; '.join(errors)))
+        #parents sort before their children
+        plan['dirs'] = sorted(dirs)
+        return plan
+
+    def execute(self, p, plan, journal, store=None, link_mode='auto', jobs=extract_jobs, backup_dir=None):
+        #carries out plan_install's plan, every change is appended to journal so
+        #rollback can undo it. with a store, zip members are unpacked into it once
+        #and placed from there
+        for installp, relp in plan['backups']:
+            if backup_dir is None:
+                raise Exception('%s exists, no backup directory to move it to' % installp)
+            bp = backup_dir / relp
+            bp.parent.mkdir(parents=True, exist_ok=True)
+            log('backing up %s to %s' % (installp, bp))
+            shutil.move(str(installp), str(bp))
+            journal.append(('backup', installp, bp))
+        for installp in plan['removes']:
+            log('removing %s' % installp)
+            #kept aside like replaced files, deleted when the install commits
+            old = installp.with_name(installp.name + old_ext)
+            os.replace(str(installp), str(old))
+            journal.append(('replace', installp, old))
+        for d in plan['rmdirs']:
+            journal.append(('rmdir', d))
+        start = len(journal)
+        for d in plan['dirs']:
+            make_dirs(d, journal)
+        #parents of members without a directory entry, removed with the package
+        created = plan['created'] + [str(entry[1].relative_to(self.quake_path)) for entry in journal[start:]]
+
+        from zipfile import ZipFile
+        from concurrent.futures import ThreadPoolExecutor
+        #every worker opens its own ZipFile so reads do not serialize on one file handle
+        local = threading.local()
+        opened = []
+        def zipfile(cpath):
+            zfs = local.__dict__.setdefault('zfs', {})
+            if cpath not in zfs:
+                zfs[cpath] = ZipFile(str(cpath), 'r')
+                opened.append(zfs[cpath])
+            return zfs[cpath]
+
+        def write(op):
+            installp, f, (cpath, member, zipinfo), replace = op
+            log('writing %s' % installp)
+            if replace:
+                old = installp.with_name(installp.name + old_ext)
+                os.replace(str(installp), str(old))
+                journal.append(('replace', installp, old))
+            if member is None:
+                place_file(cpath.resolve(), installp, link_mode)
+            elif store is not None:
+                zf = zipfile(cpath)
+                place_file(store.unpack(zf, member, f[FileInfo.hash_key]), installp, link_mode)
+            else:
+                with zipfile(cpath).open(member, 'r') as src, atomic_write(installp, 'wb') as fd:
+                    shutil.copyfileobj(src, fd, hash_bufsize)
+            journal.append(('file', installp))
+
+        writes = plan['writes']
+        try:
+            if jobs > 1 and len(writes) > 1:
+                with ThreadPoolExecutor(jobs) as pool:
+                    list(pool.map(write, writes))
+            else:
+                for op in writes:
+                    write(op)
+        finally:
+            for zf in opened:
+                zf.close()
+        instrument.count('files', len(writes))
+        instrument.count('written', sum([f['size'] for installp, f, source, replace in writes]))
+
+        return {'written': plan['written'], 'fingerprints': self.fingerprints(plan['basedir'], plan['written']), 'dirs': created}
+
+    def members(self, plan, cpath):
+        #[(member, file info)] of the archive at cpath the plan writes
+        return [(source[1], f) for installp, f, source, replace in plan['writes'] if source[0] == cpath]
+
+    def unpacked(self, plan, cpath, store):
+        #writes members of cpath from their store objects instead, for archives that
+        #were not downloaded whole
+        plan['writes'] = [(installp, f, (store.object_path(f[FileInfo.hash_key]), None, None) if source[0] == cpath else source, replace)
+                          for installp, f, source, replace in plan['writes']]
+
+    def plan(self, installp, f, zipinfo, owned, recorded=None):
+        #write, keep (ours and unchanged), skip (identical foreign file) or an error.
+        #recorded: (file info, fingerprint) of what the installed version wrote here
+        isdir = FileInfo.is_dir(f)
+        try:
+            st = installp.stat()
+        except FileNotFoundError:
+            return 'write'
+        if isdir:
+            if stat.S_ISDIR(st.st_mode):
+                #the installed version made it, still ours to remove
+                return 'keep' if recorded is not None else 'skip'
+            return 'error: directory %s exists' % installp
+        if stat.S_ISDIR(st.st_mode):
+            return 'error: directory %s exists, expected file' % installp
+        if owned and recorded is not None and recorded[1] == stat_fingerprint(st):
+            #untouched since the installed version wrote it
+            return 'keep' if recorded[0][FileInfo.hash_key] == f[FileInfo.hash_key] else 'write'
+        same = st.st_size == f['size'] and self.same_content(installp, f, zipinfo)
+        if owned:
+            return 'keep' if same else 'write'
+        if same:
+            return 'skip'
+        return 'error: file %s exists with different hash' % installp
+
+    def same_content(self, installp, f, zipinfo):
+        #the zip stores a crc32 per member, much cheaper to compute than a sha1
+        if zipinfo is None:
+            return hash_path(installp) == f[FileInfo.hash_key]
+        crc = 0
+        with installp.open('rb', buffering=0) as fd:
+            while True:
+                chunk = fd.read(hash_bufsize)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        return crc == zipinfo.CRC
+
+    def fingerprints(self, basedir, written_files):
+        #path -> stat fingerprint of written files, lets check and remove skip hashing
+        r = odict()
+        for path in written_files:
+            st = self.get_install_path(basedir, path).stat()
+            if not stat.S_ISDIR(st.st_mode):
+                r[path] = stat_fingerprint(st)
+        return r
+
+    def file_info(self, files, path):
+        if path in files:
+            return files[path]
+        #check container files
+        for fp, f in files.items():
+            sfiles = f.get('subfiles') or {}
+            #todo handle relative paths?
+            if path in sfiles:
+                return sfiles[path]
+        return None
+
+    def installed_files(self, pkg, state):
+        #[(path, install path, file info, fingerprint or None)] of everything an install wrote
         files = pkg['files']
+        basedir = self.basedir(pkg['type'][self.name])
+        fingerprints = state.get('fingerprints', {})
+        r = []
+        for path in state['written']:
+            pinfo = self.file_info(files, path)
+            if not pinfo:
+                raise Exception('%s was written, but was not found in pkg file for  %s' % (path, pkg['name']))
+            r.append((path, self.get_install_path(basedir, path), pinfo, fingerprints.get(path)))
+        return r
 
-        subpkg = pkg['type'][self.name]
-        basedir = self.basedir(subpkg)
+    def previous(self, pkg, state):
+        #target -> (install path, file info, fingerprint or None) of what an install of pkg wrote
+        basedir = self.basedir(pkg['type'][self.name])
+        r = odict([(self.target(basedir, path), (installp, pinfo, fingerprint))
+                   for path, installp, pinfo, fingerprint in self.installed_files(pkg, state)])
+        for target in state.get('dirs', []):
+            r.setdefault(target, (self.quake_path / target, FileInfo(0), None))
+        return r
 
+    def remove(self, pkg, state):
         to_remove = []
-        install_paths = [self.get_install_path(basedir, path) for path in written_files]
-
-        for path, install_path in zip(written_files, install_paths):
+        for path, install_path, pinfo, fingerprint in self.installed_files(pkg, state):
             #print(path)
             if not install_path.exists():
                 raise Exception('%s was written, but does not exist anymore')
             
-            pinfo = None
-            if path in files:
-                pinfo = files[path]
-            else:
-                #check container files
-                for fp, f in files.items():
-                    if 'subfiles' in f:
-                        sfiles = f['subfiles']
-                        #todo handle relative paths?
-                        if path in sfiles:
-                            pinfo = sfiles[path]
-                            break
-            if not pinfo:
-                raise Exception('%s was written, but was not found in pkg file for  %s' % (path, pkg['name']))
             if FileInfo.is_dir(pinfo):
                 #for subf in install_path.iterdir():
                 #    if subf not in install_paths:
                 #        raise Exception('File %s in %s/ was not installed, cannot delete dir' % (subf, path))
-                if not len(installed_path.iterdir()):
-                    to_remove.append(install_path)
+                #removed below if nothing else is left in it
+                to_remove.append(install_path)
             else:
                 stats = install_path.stat()
                 if pinfo['size'] != stats.st_size:
                     raise Exception('%s was written, but was modified' % (path))
-                if pinfo[FileInfo.hash_key] != hash_path(install_path):
+                #untouched since install, no need to hash
+                if stat_fingerprint(stats) != fingerprint and pinfo[FileInfo.hash_key] != hash_path(install_path):
                     raise Exception('%s was written, but was modified' % (path))
                 to_remove.append(install_path)
         #print('removing %s.' % ', '.join([str(p) for p in to_remove]))
 
-        dirs = []
+        dirs = [self.quake_path / target for target in state.get('dirs', []) if (self.quake_path / target).is_dir()]
         for path in to_remove :
             if path.is_dir():
                 dirs.append(path)
@@ -165,7 +358,10 @@ class QuakeBsp:
             log('Removing %s' % path)
             path.unlink()
 
-        for path in dirs:
+        #children before their parents
+        for path in sorted(set(dirs), reverse=True):
+            if any(path.iterdir()):
+                continue
             log('Removing %s' % path)
             path.rmdir()
 
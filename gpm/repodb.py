@@ -0,0 +1,236 @@
+import re
+import json
+import math
+import sqlite3
+from collections import OrderedDict as odict
+from collections.abc import Mapping
+
+from common import json_pairs, json_default
+
+#compiled, merged view of all repository indexes. rebuilt when a repo json is newer
+#than the index or the configured repos changed, so commands only parse the
+#packages they touch.
+#also holds an inverted index of the words in the latest version of every package
+#for list --search
+
+schema_version = 2
+
+schema = '''
+create table meta (key text primary key, value text);
+create table versions (
+    id integer primary key,
+    name text not null,
+    version text not null,
+    repo text not null,
+    data text not null,
+    files text
+);
+create unique index versions_name on versions (name, version);
+create table postings (
+    term text not null,
+    name text not null,
+    score real not null,
+    primary key (term, name)
+) without rowid;
+'''
+
+#searched fields and their weights. fields missing from a package are looked up in
+#its type data, like the quake-bsp title
+search_fields = [('name', 8), ('title', 6), ('keywords', 4), ('author', 3), ('description', 1)]
+#a word that is only a prefix of a term scores this share of an exact match
+prefix_weight = 0.5
+word_re = re.compile(r'[^\W_]+')
+#sorts after every term starting with a prefix
+max_char = '\U0010ffff'
+
+def loads(s):
+    return json.loads(s, object_pairs_hook=json_pairs)
+
+
+def build(db_path, repo_data):
+    #later repos shadow packages of the same name in earlier ones, like package_data.update
+    merged = odict()
+    for repo, data in repo_data.items():
+        for name, versions in (data or {}).items():
+            merged[name] = (repo, versions)
+
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = db_path.with_suffix(db_path.suffix + '.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    db = sqlite3.connect(str(tmp))
+    try:
+        db.executescript(schema)
+        rows = []
+        for name, (repo, versions) in merged.items():
+            for version, p in versions.items():
+                p = odict(p)
+                files = p.pop('files', None)
+                rows.append((name, version, repo, json.dumps(p),
+                             None if files is None else json.dumps(files, default=json_default)))
+        db.executemany('insert into versions (name, version, repo, data, files) values (?, ?, ?, ?, ?)', rows)
+        #the latest version of every package, by key order like latest_version
+        postings_ = postings([(name, versions[sorted(versions)[-1]]) for name, (repo, versions) in merged.items() if versions])
+        df = odict()
+        for term, name, weight in postings_:
+            df[term] = df.get(term, 0) + 1
+        #rare terms score higher
+        db.executemany('insert into postings values (?, ?, ?)',
+                       [(term, name, weight * math.log(1 + len(merged) / df[term])) for term, name, weight in postings_])
+        db.execute('insert into meta values (?, ?)', ('schema', str(schema_version)))
+        db.execute('insert into meta values (?, ?)', ('repos', json.dumps(list(repo_data))))
+        db.commit()
+    finally:
+        db.close()
+    tmp.replace(db_path)
+
+
+def words(value):
+    #lowercase words of the strings in value, lists and dict values included
+    if isinstance(value, str):
+        return word_re.findall(value.lower())
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return [w for v in value for w in words(v)]
+    return []
+
+def field_value(p, field):
+    if field in p:
+        return p[field]
+    return [data.get(field) for data in p.get('type', {}).values() if isinstance(data, dict)]
+
+def postings(packages):
+    #[(term, name, weight)] for [(name, package)], weight sums the weights of the
+    #fields the term occurs in
+    r = []
+    for name, p in packages:
+        weights = odict()
+        for field, weight in search_fields:
+            for w in set(words(field_value(p, field))):
+                weights[w] = weights.get(w, 0) + weight
+        r += [(term, name, weight) for term, weight in weights.items()]
+    return r
+
+
+def is_stale(db_path, repo_paths):
+    #repo_paths: repo -> path of its json, in configuration order
+    if not db_path.exists():
+        return True
+    mtime = db_path.stat().st_mtime_ns
+    #written in the same clock tick as the index counts as newer
+    if any([p.exists() and p.stat().st_mtime_ns >= mtime for p in repo_paths.values()]):
+        return True
+    #built by an older gpm or for other repos
+    db = sqlite3.connect(str(db_path))
+    try:
+        meta = dict(db.execute('select key, value from meta'))
+    finally:
+        db.close()
+    return meta.get('schema') != str(schema_version) or meta.get('repos') != json.dumps(list(repo_paths))
+
+
+class PackageIndex(Mapping):
+    #name -> odict(version -> package), loaded per name on first access
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(str(db_path))
+        self.loaded = {}
+
+    def versions(self, name):
+        if name not in self.loaded:
+            rows = self.db.execute('select version, data, files from versions where name = ? order by id', (name,)).fetchall()
+            if not rows:
+                raise KeyError(name)
+            versions = odict()
+            for version, data, files in rows:
+                p = loads(data)
+                if files is not None:
+                    p['files'] = loads(files)
+                versions[version] = p
+            self.loaded[name] = versions
+        return self.loaded[name]
+
+    def __getitem__(self, name):
+        return self.versions(name)
+
+    def search(self, query):
+        #[(name, score)] of the packages matching every word of query, best first. a
+        #word matches the terms it is a prefix of, scored by field weight and rarity
+        scores = None
+        for word in set(words(query)):
+            rows = self.db.execute('select name, max(score * (case when term = ? then 1.0 else ? end)) from postings '
+                                   'where term >= ? and term < ? group by name',
+                                   (word, prefix_weight, word, word + max_char))
+            found = dict(rows.fetchall())
+            if scores is None:
+                scores = found
+            else:
+                scores = dict([(n, s + found[n]) for n, s in scores.items() if n in found])
+        return sorted((scores or {}).items(), key=lambda t: (-t[1], t[0]))
+
+    def repo(self, name):
+        row = self.db.execute('select repo from versions where name = ? limit 1', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def __contains__(self, name):
+        if name in self.loaded:
+            return True
+        return self.db.execute('select 1 from versions where name = ? limit 1', (name,)).fetchone() is not None
+
+    def __iter__(self):
+        for (name,) in self.db.execute('select name from versions group by name order by min(id)'):
+            yield name
+
+    def __len__(self):
+        return self.db.execute('select count(distinct name) from versions').fetchone()[0]
+
+
+class LazyRepos(Mapping):
+    #repo -> repo data, parsed only when a command asks for it
+    def __init__(self, repos, load):
+        self.repos = repos
+        self.load = load
+        self.loaded = {}
+
+    def __getitem__(self, repo):
+        if repo not in self.repos:
+            raise KeyError(repo)
+        if repo not in self.loaded:
+            self.loaded[repo] = self.load(repo)
+        return self.loaded[repo]
+
+    def __iter__(self):
+        return iter(self.repos)
+
+    def __len__(self):
+        return len(self.repos)
+
+
+class Deferred(Mapping):
+    #a mapping made by load() on first access
+    def __init__(self, load):
+        self.load = load
+        self.loaded = None
+
+    def mapping(self):
+        if self.loaded is None:
+            self.loaded = self.load()
+        return self.loaded
+
+    def __getitem__(self, key):
+        return self.mapping()[key]
+
+    def __contains__(self, key):
+        return key in self.mapping()
+
+    def __iter__(self):
+        return iter(self.mapping())
+
+    def __len__(self):
+        return len(self.mapping())
+
+    def __getattr__(self, attr):
+        #methods of the loaded mapping, like PackageIndex.repo
+        return getattr(self.mapping(), attr)
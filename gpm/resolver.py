@@ -0,0 +1,482 @@
+import re
+from collections import OrderedDict as odict
+from functools import lru_cache
+
+#npm style version ranges and a backtracking resolver over the package index.
+#
+#versions are compared by key tuples: (major, minor, patch, 1, ()) for releases,
+#(major, minor, patch, 0, prerelease ids) for prereleases, so X.Y.Z-0 is the
+#lowest version of X.Y.Z like in node-semver
+
+version_re = re.compile(r'^\s*v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?\s*$')
+partial_re = re.compile(r'^v?(?:([0-9]+|[xX*])(?:\.([0-9]+|[xX*])(?:\.([0-9]+|[xX*])(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?)?)?)?$')
+comparator_re = re.compile(r'^(<=|>=|<|>|=|~>?|\^)?\s*(.*)$')
+hyphen_re = re.compile(r'^\s*(\S+)\s+-\s+(\S+)\s*$')
+
+def prerelease_key(pre):
+    if not pre:
+        return (1, ())
+    return (0, tuple([(0, int(p)) if p.isdigit() else (1, p) for p in pre.split('.')]))
+
+@lru_cache(maxsize=None)
+def parse_version(v):
+    m = version_re.match(v)
+    if not m:
+        raise ValueError('Invalid version: %s' % v)
+    major, minor, patch, pre = m.groups()
+    return (int(major), int(minor), int(patch)) + prerelease_key(pre)
+
+def is_prerelease(key):
+    return key[3] == 0
+
+#lowest possible version of major.minor.patch
+def floor(major, minor, patch):
+    return (major, minor, patch, 0, ((0, 0),))
+
+def release(major, minor, patch, pre=None):
+    return (major, minor, patch) + prerelease_key(pre)
+
+
+def is_wild(p):
+    return p is None or p in ('x', 'X', '*')
+
+def parse_partial(s):
+    m = partial_re.match(s)
+    if not m:
+        raise ValueError('Invalid version range: %s' % s)
+    parts = list(m.groups()[:3])
+    pre = m.group(4)
+    #everything after a wildcard is a wildcard
+    for i, p in enumerate(parts):
+        if is_wild(p):
+            parts[i:] = [None] * (3 - i)
+            pre = None
+            break
+    return [None if p is None else int(p) for p in parts], pre
+
+def x_range(parts, pre):
+    #[(op, key)] for a partial version without operator
+    major, minor, patch = parts
+    if major is None:
+        return []
+    if minor is None:
+        return [('>=', release(major, 0, 0)), ('<', floor(major + 1, 0, 0))]
+    if patch is None:
+        return [('>=', release(major, minor, 0)), ('<', floor(major, minor + 1, 0))]
+    return [('=', release(major, minor, patch, pre))]
+
+def tilde(parts, pre):
+    major, minor, patch = parts
+    if major is None:
+        return []
+    if minor is None:
+        return [('>=', release(major, 0, 0)), ('<', floor(major + 1, 0, 0))]
+    return [('>=', release(major, minor, patch or 0, pre)), ('<', floor(major, minor + 1, 0))]
+
+def caret(parts, pre):
+    major, minor, patch = parts
+    if major is None:
+        return []
+    lower = ('>=', release(major, minor or 0, patch or 0, pre))
+    if major > 0 or minor is None:
+        return [lower, ('<', floor(major + 1, 0, 0))]
+    if minor > 0 or patch is None:
+        return [lower, ('<', floor(0, minor + 1, 0))]
+    return [lower, ('<', floor(0, 0, patch + 1))]
+
+def bound(op, parts, pre):
+    major, minor, patch = parts
+    if major is None:
+        #>* and <* match nothing, >=* and <=* anything
+        return [] if op in ('>=', '<=') else [('<', floor(0, 0, 0))]
+    if patch is not None:
+        return [(op, release(major, minor, patch, pre))]
+    if minor is None:
+        nxt = (major + 1, 0, 0)
+        low = release(major, 0, 0)
+    else:
+        nxt = (major, minor + 1, 0)
+        low = release(major, minor, 0)
+    if op == '>':
+        #>1.2 is >=1.3.0, prereleases of 1.3.0 stay out
+        return [('>=', release(*nxt))]
+    if op == '<=':
+        return [('<', floor(*nxt))]
+    if op == '<':
+        return [('<', floor(*low[:3]))]
+    return [('>=', low)]
+
+def hyphen(lo, hi):
+    lparts, lpre = parse_partial(lo)
+    hparts, hpre = parse_partial(hi)
+    r = []
+    if lparts[0] is not None:
+        r.append(('>=', release(lparts[0], lparts[1] or 0, lparts[2] or 0, lpre)))
+    if hparts[0] is not None:
+        if hparts[2] is not None:
+            r.append(('<=', release(hparts[0], hparts[1], hparts[2], hpre)))
+        else:
+            r += bound('<=', hparts, None)
+    return r
+
+def parse_comparator(c):
+    m = comparator_re.match(c)
+    op, rest = m.groups()
+    parts, pre = parse_partial(rest.strip())
+    if op is None or op == '=':
+        return x_range(parts, pre)
+    if op[0] == '~':
+        return tilde(parts, pre)
+    if op == '^':
+        return caret(parts, pre)
+    return bound(op, parts, pre)
+
+@lru_cache(maxsize=None)
+def parse_range(r):
+    #compiled range: tuple of comparator sets, a version matches if it matches all
+    #comparators of any set
+    sets = []
+    for part in r.split('||'):
+        part = part.strip()
+        m = hyphen_re.match(part)
+        if m:
+            sets.append(tuple(hyphen(*m.groups())))
+            continue
+        #'>= 1.2' style spacing
+        part = re.sub(r'(<=|>=|<|>|=|~>?|\^)\s+', r'\1', part)
+        comparators = []
+        for c in part.split():
+            comparators += parse_comparator(c)
+        sets.append(tuple(comparators))
+    return tuple(sets)
+
+def test_comparator(key, op, bound_key):
+    if op == '=':
+        return key == bound_key
+    if op == '<':
+        return key < bound_key
+    if op == '<=':
+        return key <= bound_key
+    if op == '>':
+        return key > bound_key
+    return key >= bound_key
+
+def test_set(key, comparators):
+    for op, b in comparators:
+        if not test_comparator(key, op, b):
+            return False
+    if is_prerelease(key):
+        #prereleases only match if a comparator names a prerelease of the same version
+        return any([is_prerelease(b) and b[:3] == key[:3] for op, b in comparators])
+    return True
+
+@lru_cache(maxsize=1 << 16)
+def satisfies(version, range_):
+    key = parse_version(version)
+    return any([test_set(key, s) for s in parse_range(range_)])
+
+
+class ResolveError(Exception):
+    pass
+
+
+class Frame:
+    __slots__ = ['name', 'candidates', 'index', 'qi', 'qlen', 'added', 'conflicts']
+
+    def __init__(self, name, candidates, qi, qlen, conflicts):
+        self.name = name
+        self.candidates = candidates
+        self.index = -1
+        #queue position of name and queue length before its dependencies were added
+        self.qi = qi
+        self.qlen = qlen
+        #(dep, constraint) added by the current choice
+        self.added = []
+        #packages whose choices ruled out candidates of this one
+        self.conflicts = conflicts
+
+
+class Resolver:
+    #package_data: name -> odict(version -> package)
+    #installed: name -> odict(version, as_dependency: odict(required_by -> range)), like InstalledState
+    def __init__(self, package_data, installed=None):
+        self.package_data = package_data
+        self.installed = installed or {}
+        self.sorted_versions = {}
+
+    def versions(self, name):
+        #newest first
+        if name not in self.sorted_versions:
+            vs = list(self.package_data[name].keys())
+            vs.sort(key=parse_version, reverse=True)
+            self.sorted_versions[name] = vs
+        return self.sorted_versions[name]
+
+    def dependencies(self, name, version):
+        return self.package_data[name][version].get('dependencies') or odict()
+
+    def blame(self, names):
+        #the choice to revise for a conflict caused by any one of names: None if one of
+        #them is fixed (requested or installed outside this resolution), else the oldest
+        best = None
+        for n in names:
+            if n not in self.order:
+                return None
+            if best is None or self.order[n] < self.order[best]:
+                best = n
+        return best
+
+    def candidates(self, name, constraints):
+        #returns (versions, conflicts): matching versions in preference order and the
+        #choices that ruled out the others or pulled in name
+        vs = []
+        conflicts = set([self.blame([by for by, r in constraints])])
+        for v in self.versions(name):
+            excluded_by = [by for by, r in constraints if not satisfies(v, r)]
+            if excluded_by:
+                conflicts.add(self.blame(excluded_by))
+            else:
+                vs.append(v)
+        if name in self.installed and name not in self.upgrade:
+            #keep what is installed if it still fits
+            inst = self.installed[name]['version']
+            if inst in vs:
+                vs.remove(inst)
+                vs.insert(0, inst)
+        conflicts.discard(None)
+        return vs, conflicts
+
+    def resolve(self, roots, upgrade=()):
+        #roots: [(name, range)]. returns odict(name -> (version, [(required_by, range)]))
+        #with dependencies before their dependents
+        self.upgrade = set(upgrade)
+        self.assignment = odict()
+        self.constraints = {}
+        self.queue = []
+        self.queued = set()
+        #assignment order, conflicts are blamed on the oldest choice involved
+        self.order = {}
+        self.counter = 0
+        #learned conflicts, each a list of (name, version) choices that cannot all be made
+        #together. (name, version) -> nogoods watching it, see watch
+        self.watches = {}
+        self.learned = set()
+        #name -> (dep, range) of the last candidate of name that failed because no
+        #version of dep is in range, for the error message
+        self.missing = {}
+        for name, range_ in roots:
+            if name not in self.package_data:
+                raise ResolveError('No such package: ' + name)
+            if name not in self.constraints:
+                self.constraints[name] = self.installed_constraints(name)
+            self.constraints[name].append((None, range_))
+            if name not in self.queued:
+                self.queue.append(name)
+                self.queued.add(name)
+
+        #choice points, see Frame. a frame that runs out of candidates jumps back to the
+        #latest frame in its conflict set instead of the previous one (backjumping)
+        stack = []
+        qi = 0
+        while qi < len(self.queue):
+            name = self.queue[qi]
+            if name in self.assignment:
+                qi += 1
+                continue
+            cands, conflicts = self.candidates(name, self.constraints[name])
+            frame = Frame(name, cands, qi, len(self.queue), conflicts)
+            stack.append(frame)
+            qi = self.next_choice(frame)
+            if qi is None:
+                qi = self.backjump(stack, name)
+
+        result = odict()
+        for name in self.install_order(roots):
+            required_by = [(by, r) for by, r in self.constraints[name] if by is not None]
+            result[name] = (self.assignment[name], required_by)
+        return result
+
+    def installed_constraints(self, name):
+        #installed packages that are not part of this resolution keep their requirements
+        if name not in self.installed:
+            return []
+        return [(by, r) for by, r in self.installed[name]['as_dependency'].items() if by not in self.upgrade]
+
+    def undo(self, frame):
+        self.assignment.pop(frame.name, None)
+        self.order.pop(frame.name, None)
+        for dep, c in reversed(frame.added):
+            self.constraints[dep].remove(c)
+            if not self.constraints[dep]:
+                del self.constraints[dep]
+        frame.added = []
+        for dep in self.queue[frame.qlen:]:
+            self.queued.discard(dep)
+        del self.queue[frame.qlen:]
+
+    def forward_conflicts(self, name, range_):
+        #None if an unassigned name still has a version matching range_ and its other
+        #requirements, else the choices that rule them out
+        cs = self.constraints.get(name, [])
+        conflicts = set()
+        for v in self.versions(name):
+            if not satisfies(v, range_):
+                continue
+            excluded_by = [by for by, r in cs if not satisfies(v, r)]
+            if not excluded_by:
+                return None
+            conflicts.add(self.blame(excluded_by))
+        conflicts.discard(None)
+        return conflicts
+
+    def next_choice(self, frame):
+        #tries the next candidate of frame, returns the queue position to continue at
+        name = frame.name
+        self.undo(frame)
+        while frame.index + 1 < len(frame.candidates):
+            frame.index += 1
+            version = frame.candidates[frame.index]
+            deps = self.dependencies(name, version)
+            ok = True
+            for dep, r in deps.items():
+                if dep not in self.package_data:
+                    raise ResolveError('No such package: %s (as dependency of %s)' % (dep, name))
+                if dep in self.assignment:
+                    if not satisfies(self.assignment[dep], r):
+                        frame.conflicts.add(dep)
+                        ok = False
+                        break
+                else:
+                    #forward check: other requirements on dep may already rule out r
+                    conflicts = self.forward_conflicts(dep, r)
+                    if conflicts is not None:
+                        if not conflicts and not any([satisfies(v, r) for v in self.versions(dep)]):
+                            self.missing[name] = (dep, r)
+                        frame.conflicts.update(conflicts)
+                        ok = False
+                        break
+            if not ok:
+                continue
+            nogood = self.violated_nogood(name, version)
+            if nogood is not None:
+                frame.conflicts.update([n for n, v in nogood if n != name])
+                continue
+            self.assignment[name] = version
+            self.watch(name, version)
+            self.order[name] = self.counter
+            self.counter += 1
+            for dep, r in deps.items():
+                if dep not in self.constraints:
+                    self.constraints[dep] = []
+                    for c in self.installed_constraints(dep):
+                        self.constraints[dep].append(c)
+                        frame.added.append((dep, c))
+                c = (name, r)
+                self.constraints[dep].append(c)
+                frame.added.append((dep, c))
+                if dep not in self.queued:
+                    self.queue.append(dep)
+                    self.queued.add(dep)
+            return frame.qi + 1
+        return None
+
+    def violated_nogood(self, name, version):
+        #a nogood only needs a look if it watches this choice
+        for nogood in self.watches.get((name, version), []):
+            for other, v in nogood:
+                if other != name and self.assignment.get(other) != v:
+                    break
+            else:
+                return nogood
+        return None
+
+    def watch(self, name, version):
+        #every nogood watches its first two choices, kept to ones not made while it has
+        #them. when a watched choice is made the nogood moves on to another one that is
+        #not, if there is none only its other watch can still violate it and it stays.
+        #choices are undone in reverse order, so watches are never restored on backjumps
+        watching = self.watches.get((name, version))
+        if not watching:
+            return
+        kept = []
+        for nogood in watching:
+            if nogood[0] == (name, version):
+                nogood[0], nogood[1] = nogood[1], nogood[0]
+            for i in range(2, len(nogood)):
+                other, v = nogood[i]
+                if self.assignment.get(other) != v:
+                    nogood[1], nogood[i] = nogood[i], nogood[1]
+                    self.watches.setdefault(nogood[1], []).append(nogood)
+                    break
+            else:
+                kept.append(nogood)
+        self.watches[(name, version)] = kept
+
+    def learn(self, conflicts):
+        #the current choices of conflicts are what made a frame fail, remember them so
+        #other branches do not run into the same failure again
+        nogood = [(n, self.assignment[n]) for n in conflicts if n in self.assignment]
+        key = frozenset(nogood)
+        if key in self.learned:
+            return
+        self.learned.add(key)
+        #the latest choices are undone first, they are watched
+        nogood.sort(key=lambda c: self.order[c[0]], reverse=True)
+        for c in nogood[:2]:
+            self.watches.setdefault(c, []).append(nogood)
+
+    def backjump(self, stack, failed):
+        failed_constraints = list(self.constraints.get(failed, []))
+        while stack:
+            frame = stack.pop()
+            self.undo(frame)
+            conflicts = frame.conflicts
+            conflicts.discard(frame.name)
+            self.learn(conflicts)
+            while stack and stack[-1].name not in conflicts:
+                self.undo(stack.pop())
+            if not stack:
+                break
+            target = stack[-1]
+            target.conflicts |= conflicts
+            qi = self.next_choice(target)
+            if qi is not None:
+                return qi
+        self.fail(failed, failed_constraints)
+
+    def fail(self, name, cs):
+        requested = ', '.join(['%s @%s' % (by or '(requested)', r or '*') for by, r in cs])
+        matching = [v for v in self.versions(name) if all([satisfies(v, r) for by, r in cs])]
+        if matching and name in self.missing:
+            #a dependency of name has nothing in range, that is what to report
+            dep, r = self.missing[name]
+            raise ResolveError('Package %s required at version %s but no matching versions (found: %s)' % (
+                dep, r, ', '.join(self.versions(dep))))
+        if matching:
+            raise ResolveError('Package %s required at version %s, but all matching versions (%s) conflict with other dependencies'
+                               % (name, requested, ', '.join(matching)))
+        if len(cs) > 1 and any([satisfies(v, r) for v in self.versions(name) for by, r in cs]):
+            raise ResolveError('Package %s required at conflicting versions: %s' % (name, requested))
+        raise ResolveError('Package %s required at version %s but no matching versions (found: %s)' % (
+            name, requested, ', '.join(self.versions(name))))
+
+    def install_order(self, roots):
+        assignment = self.assignment
+        order = []
+        done = set()
+        for root, _ in roots:
+            if root in done:
+                continue
+            done.add(root)
+            stack = [(root, iter(self.dependencies(root, assignment[root])))]
+            while stack:
+                name, deps = stack[-1]
+                for dep in deps:
+                    if dep not in done:
+                        done.add(dep)
+                        stack.append((dep, iter(self.dependencies(dep, assignment[dep]))))
+                        break
+                else:
+                    stack.pop()
+                    order.append(name)
+        return order
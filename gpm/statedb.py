@@ -0,0 +1,262 @@
+import json
+import sqlite3
+from collections import OrderedDict as odict
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+from common import log, json_default
+
+#installed packages, their dependency edges, written files, file ownership and
+#package snapshots in one sqlite database. every change runs in a transaction
+
+schema = '''
+create table if not exists packages (
+    name text primary key,
+    version text not null,
+    date text not null,
+    package text not null
+);
+create table if not exists dependencies (
+    name text not null,
+    required_by text not null,
+    range text not null,
+    primary key (name, required_by)
+);
+create index if not exists dependencies_required_by on dependencies (required_by);
+create table if not exists handler_states (
+    name text not null,
+    type text not null,
+    data text not null,
+    primary key (name, type)
+);
+create table if not exists files (
+    name text not null,
+    type text not null,
+    path text not null,
+    seq integer not null,
+    size integer,
+    mtime_ns integer,
+    ino integer
+);
+create index if not exists files_name on files (name, type);
+create table if not exists owners (
+    path text not null,
+    type text not null,
+    name text not null,
+    primary key (type, path, name)
+);
+create index if not exists owners_name on owners (name);
+'''
+
+fingerprint_columns = ['size', 'mtime_ns', 'ino']
+
+#paths per query, below sqlite's default variable limit
+query_chunk = 500
+
+def loads(s):
+    return json.loads(s, object_pairs_hook=odict)
+
+
+class InstalledState(Mapping):
+    #name -> odict(date, version, as_dependency), like the old installed.json
+    def __init__(self, db_path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(db_path), isolation_level=None)
+        self.db.execute('pragma journal_mode=wal')
+        #a commit is durable once it returns, installs commit once at the end
+        self.db.execute('pragma synchronous=full')
+        self.db.executescript(schema)
+        #files of databases from before stat fingerprints were recorded
+        columns = [r[1] for r in self.db.execute('pragma table_info(files)')]
+        for c in fingerprint_columns:
+            if c not in columns:
+                self.db.execute('alter table files add column %s integer' % c)
+        self.depth = 0
+
+    @contextmanager
+    def transaction(self):
+        #nests, only the outermost one commits
+        if self.depth == 0:
+            self.db.execute('begin immediate')
+        self.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0:
+                self.db.execute('rollback')
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.db.execute('commit')
+
+    def __getitem__(self, name):
+        row = self.db.execute('select date, version from packages where name = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        date, version = row
+        return odict([('date', date), ('version', version), ('as_dependency', self.required_by(name))])
+
+    def __contains__(self, name):
+        return self.db.execute('select 1 from packages where name = ?', (name,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([n for (n,) in self.db.execute('select name from packages order by rowid')])
+
+    def __len__(self):
+        return self.db.execute('select count(*) from packages').fetchone()[0]
+
+    def version(self, name):
+        row = self.db.execute('select version from packages where name = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def package(self, name):
+        #snapshot of the package record as installed
+        row = self.db.execute('select package from packages where name = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return loads(row[0])
+
+    def required_by(self, name):
+        rows = self.db.execute('select required_by, range from dependencies where name = ? order by rowid', (name,))
+        return odict(rows.fetchall())
+
+    def requires(self, name):
+        #installed packages name depends on
+        rows = self.db.execute('select name from dependencies where required_by = ? order by rowid', (name,))
+        return [n for (n,) in rows]
+
+    def required(self):
+        #names at least one installed package depends on
+        return set([n for (n,) in self.db.execute('select distinct name from dependencies')])
+
+    def unneeded(self, names):
+        #dependencies that are only needed by names: everything reachable from names minus
+        #what some other package still needs, directly or through a package it keeps.
+        #marking instead of recursing settles dependency cycles
+        names = set(names)
+        reachable = odict()
+        queue = list(names)
+        while queue:
+            for dep in self.requires(queue.pop()):
+                if dep not in reachable and dep not in names:
+                    reachable[dep] = None
+                    queue.append(dep)
+        removing = names | set(reachable)
+        kept = set()
+        for dep in reachable:
+            others = [by for by in self.required_by(dep) if by not in removing]
+            if others:
+                log('%s still required by %s' % (dep, ', '.join(others)))
+                kept.add(dep)
+        queue = list(kept)
+        while queue:
+            for dep in self.requires(queue.pop()):
+                if dep in reachable and dep not in kept:
+                    kept.add(dep)
+                    queue.append(dep)
+        return [dep for dep in reachable if dep not in kept]
+
+    def handler_states(self, name):
+        states = odict()
+        for t, data in self.db.execute('select type, data from handler_states where name = ? order by rowid', (name,)):
+            state = loads(data)
+            state['written'] = self.written(name, t)
+            state['fingerprints'] = self.fingerprints(name, t)
+            states[t] = state
+        return states
+
+    def written(self, name, t):
+        rows = self.db.execute('select path from files where name = ? and type = ? order by seq', (name, t))
+        return [p for (p,) in rows]
+
+    def fingerprints(self, name, t):
+        #path -> [size, mtime_ns, ino] as recorded at install
+        rows = self.db.execute('select path, size, mtime_ns, ino from files where name = ? and type = ? and size is not null order by seq', (name, t))
+        return odict([(p, list(fp)) for p, *fp in rows])
+
+    def set_fingerprint(self, name, t, path, fingerprint):
+        self.db.execute('update files set size = ?, mtime_ns = ?, ino = ? where name = ? and type = ? and path = ?',
+                        tuple(fingerprint) + (name, t, path))
+
+    def owned(self, name, t):
+        rows = self.db.execute('select path from owners where name = ? and type = ? order by rowid', (name, t))
+        return [p for (p,) in rows]
+
+    def set_owned(self, name, t, paths):
+        with self.transaction():
+            self.db.execute('delete from owners where name = ? and type = ?', (name, t))
+            self.db.executemany('insert or ignore into owners values (?, ?, ?)', [(p, t, name) for p in paths])
+
+    def owners(self, t, paths):
+        #path -> [names] for the paths installed packages own
+        r = odict()
+        paths = list(paths)
+        for i in range(0, len(paths), query_chunk):
+            chunk = paths[i:i + query_chunk]
+            q = 'select path, name from owners where type = ? and path in (%s) order by rowid' % ', '.join('?' * len(chunk))
+            for path, name in self.db.execute(q, [t] + chunk):
+                r.setdefault(path, []).append(name)
+        return r
+
+    def shared(self):
+        #[(type, path, [names])] for paths more than one package owns
+        q = 'select type, path, group_concat(name, ?) from owners group by type, path having count(*) > 1 order by type, path'
+        return [(t, p, names.split('\n')) for t, p, names in self.db.execute(q, ('\n',))]
+
+    def unindexed(self):
+        #installed packages without ownership records, from before the owners table
+        rows = self.db.execute('select name from packages where name not in (select name from owners) order by rowid')
+        return [n for (n,) in rows]
+
+    #the dependency edges of name are dropped, add them with add_dependent once every
+    #package of an install is added
+    def add(self, name, version, date, package, handler_states, owned={}):
+        with self.transaction():
+            self.delete_rows(name)
+            self.db.execute('delete from dependencies where required_by = ?', (name,))
+            self.db.execute('insert into packages values (?, ?, ?, ?)', (name, version, date, json.dumps(package, default=json_default)))
+            for t, state in handler_states.items():
+                state = odict(state)
+                written = state.pop('written', [])
+                fingerprints = state.pop('fingerprints', {})
+                self.db.execute('insert into handler_states values (?, ?, ?)', (name, t, json.dumps(state)))
+                self.db.executemany('insert into files values (?, ?, ?, ?, ?, ?, ?)',
+                                    [(name, t, p, i) + tuple(fingerprints.get(p, [None] * 3)) for i, p in enumerate(written)])
+            for t, paths in owned.items():
+                self.set_owned(name, t, paths)
+
+    def add_dependent(self, name, required_by, range_):
+        self.db.execute('insert or replace into dependencies values (?, ?, ?)', (name, required_by, range_))
+
+    def delete_rows(self, name):
+        self.db.execute('delete from packages where name = ?', (name,))
+        self.db.execute('delete from handler_states where name = ?', (name,))
+        self.db.execute('delete from files where name = ?', (name,))
+        self.db.execute('delete from owners where name = ?', (name,))
+
+    def delete(self, name):
+        with self.transaction():
+            self.delete_rows(name)
+            self.db.execute('delete from dependencies where required_by = ? or name = ?', (name, name))
+
+    def migrate(self, installed_file, package_file, state_file):
+        #imports installed.json and the per package .json/.package files
+        if not installed_file.exists() or len(self):
+            return False
+        with installed_file.open('r') as f:
+            installed = json.load(f, object_pairs_hook=odict)
+        with self.transaction():
+            for name, inst in installed.items():
+                with package_file(name).open('r') as f:
+                    package = json.load(f, object_pairs_hook=odict)
+                with state_file(name).open('r') as f:
+                    states = json.load(f, object_pairs_hook=odict)
+                self.add(name, inst['version'], inst['date'], package, states)
+            for name, inst in installed.items():
+                for required_by, range_ in inst['as_dependency'].items():
+                    self.add_dependent(name, required_by, range_)
+        installed_file.replace(installed_file.with_suffix(installed_file.suffix + '.migrated'))
+        return True
@@ -0,0 +1,214 @@
+import os
+import errno
+import shutil
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from common import log, Hasher, FileInfo, hash_bufsize, tmp_path
+
+#content addressed file store: objects/<sha1[:2]>/<sha1>, least recently used
+#objects (by mtime, touched on every use) are evicted once the store exceeds max_size
+
+size_units = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+def parse_size(s):
+    s = str(s).strip().lower().rstrip('b')
+    unit = ''
+    if s and s[-1] in 'kmgt':
+        unit, s = s[-1], s[:-1]
+    return int(float(s) * size_units[unit])
+
+def format_size(n):
+    for unit in ['', 'K', 'M', 'G']:
+        if n < 1024:
+            return '%.1f%s' % (n, unit) if unit else '%i' % n
+        n /= 1024
+    return '%.1fT' % n
+
+
+#ways of placing a cached file into a game directory, tried in order. hardlinks
+#share the inode with the cache, so editing an installed file edits the cache
+link_modes = {
+    'auto': ['reflink', 'copy_range', 'copy'],
+    'hardlink': ['hardlink', 'reflink', 'copy_range', 'copy'],
+    'reflink': ['reflink', 'copy'],
+    'copy': ['copy'],
+}
+#linux/fs.h
+FICLONE = 0x40049409
+
+def hardlink(src, dst):
+    os.link(str(src), str(dst))
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported here')
+    with open(str(src), 'rb') as s, open(str(dst), 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def copy_range(src, dst):
+    #in kernel copy, can share extents on filesystems that support it
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.EOPNOTSUPP, 'copy_file_range is not supported here')
+    with open(str(src), 'rb') as s, open(str(dst), 'wb') as d:
+        remaining = os.fstat(s.fileno()).st_size
+        while remaining > 0:
+            n = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+            if n == 0:
+                break
+            remaining -= n
+
+def copy(src, dst):
+    shutil.copyfile(str(src), str(dst))
+
+place_methods = {'hardlink': hardlink, 'reflink': reflink, 'copy_range': copy_range, 'copy': copy}
+
+def place_file(src, dst, mode='auto'):
+    #replaces dst with the content of src, returns the method that worked
+    tmp = tmp_path(dst)
+    methods = link_modes[mode]
+    for method in methods:
+        if tmp.exists():
+            tmp.unlink()
+        try:
+            place_methods[method](src, tmp)
+        except OSError:
+            if method == methods[-1]:
+                raise
+            continue
+        os.replace(str(tmp), str(dst))
+        return method
+
+
+class ObjectStore:
+    objects_dir = 'objects'
+
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+
+    def object_path(self, sha1):
+        return self.root / self.objects_dir / sha1[:2] / sha1
+
+    def has(self, sha1):
+        return self.object_path(sha1).is_file()
+
+    def touch(self, sha1):
+        obj = self.object_path(sha1)
+        #a hardlinked object shares its mtime with the installed file, and is not evicted anyway
+        if obj.stat().st_nlink == 1:
+            os.utime(str(obj))
+
+    def link(self, sha1, view):
+        #makes view point at the object, views are the <name>-<version>/<path> layout handlers read from
+        obj = self.object_path(sha1)
+        if view.is_symlink() or view.exists():
+            if view.is_symlink() and Path(os.readlink(str(view))) == obj:
+                self.touch(sha1)
+                return view
+            view.unlink()
+        view.parent.mkdir(parents=True, exist_ok=True)
+        view.symlink_to(obj)
+        self.touch(sha1)
+        return view
+
+    def unpack(self, zf, member, sha1):
+        #extracts a zip member into the store once, later installs place it from there
+        obj = self.object_path(sha1)
+        if obj.is_file():
+            self.touch(sha1)
+            return obj
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        #members with the same content may be unpacked by several threads at once
+        tmp = obj.with_name('%s.%i.tmp' % (obj.name, threading.get_ident()))
+        hasher = Hasher()
+        with zf.open(member, 'r') as src, tmp.open('wb') as dst:
+            while True:
+                chunk = src.read(hash_bufsize)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                dst.write(chunk)
+        if hasher.hexdigest(FileInfo.hash_key) != sha1:
+            tmp.unlink()
+            raise Exception('%s in %s does not match its hash' % (member, zf.filename))
+        tmp.replace(obj)
+        return obj
+
+    def objects(self):
+        #[(path, size, mtime)], oldest first
+        d = self.root / self.objects_dir
+        if not d.exists():
+            return []
+        r = []
+        for sub in d.iterdir():
+            if not sub.is_dir():
+                continue
+            for p in sub.iterdir():
+                st = p.stat()
+                r.append((p, st.st_size, st.st_mtime))
+        r.sort(key=lambda t: t[2])
+        return r
+
+    def views(self):
+        d = self.root
+        if not d.exists():
+            return []
+        r = []
+        for sub in d.iterdir():
+            if sub.name == self.objects_dir or sub.name.startswith('.') or not sub.is_dir():
+                continue
+            for dirpath, dirnames, filenames in os.walk(str(sub)):
+                r += [Path(dirpath) / f for f in filenames]
+        return r
+
+    def stats(self):
+        objects = self.objects()
+        views = self.views()
+        r = {
+            'objects': len([o for o in objects if not o[0].name.endswith('.part')]),
+            'partial': len([o for o in objects if o[0].name.endswith('.part')]),
+            'size': sum([o[1] for o in objects]),
+            'views': len(views),
+            'dangling': len([v for v in views if not v.exists()]),
+            'max_size': self.max_size,
+        }
+        if objects:
+            r['oldest'] = time.strftime('%Y-%m-%d %H:%M', time.localtime(objects[0][2]))
+        return r
+
+    def prune(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+        removed, freed = 0, 0
+        if max_size is not None:
+            objects = self.objects()
+            total = sum([o[1] for o in objects])
+            for p, size, mtime in objects:
+                if total <= max_size:
+                    break
+                #hardlinked into a game directory, evicting would not free anything
+                if p.stat().st_nlink > 1:
+                    continue
+                log('evicting %s' % p)
+                p.unlink()
+                total -= size
+                freed += size
+                removed += 1
+        #drop views whose object is gone
+        for v in self.views():
+            if v.is_symlink() and not v.exists():
+                v.unlink()
+        for sub in list(self.root.iterdir()) if self.root.exists() else []:
+            if sub.name.startswith('.') or not sub.is_dir():
+                continue
+            for dirpath, dirnames, filenames in os.walk(str(sub), topdown=False):
+                if not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+        return removed, freed